@@ -0,0 +1,93 @@
+"""Measure the cold-start import cost of the Lambda module.
+
+Runs ``python -X importtime -c "import lambda_function"`` in fresh
+interpreters, groups the self time of every imported module by top-level
+package and prints the median over several runs. Results can be saved as
+JSON and compared against an earlier run to catch regressions:
+
+    python benchmarks/import_time.py --json before.json
+    python benchmarks/import_time.py --baseline before.json --max-regression 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docker")
+
+
+def import_times(module):
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get("AWS_DEFAULT_REGION", "ca-central-1"))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=LAMBDA_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    packages = defaultdict(int)
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        packages[name.split(".")[0]] += int(self_us)
+        if name == module:
+            total = int(cumulative_us)
+    return total, packages
+
+
+def measure(module, runs):
+    import_times(module)  # warm the bytecode cache
+    totals = []
+    samples = defaultdict(list)
+    for _ in range(runs):
+        total, packages = import_times(module)
+        totals.append(total)
+        for package, self_us in packages.items():
+            samples[package].append(self_us)
+    return {
+        "module": module,
+        "runs": runs,
+        "total_ms": statistics.median(totals) / 1000,
+        "packages_ms": {
+            package: statistics.median(values + [0] * (runs - len(values))) / 1000
+            for package, values in samples.items()
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="lambda_function")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="packages to list")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file from an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=20.0,
+                        help="percent the total may grow over the baseline before failing")
+    args = parser.parse_args(argv)
+
+    results = measure(args.module, args.runs)
+    print(f"import {results['module']}: {results['total_ms']:.1f} ms (median of {results['runs']} runs)")
+    ranked = sorted(results["packages_ms"].items(), key=lambda item: item[1], reverse=True)
+    for package, self_ms in ranked[:args.top]:
+        print(f"  {package:<30} {self_ms:8.1f} ms")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        change = (results["total_ms"] - baseline["total_ms"]) / baseline["total_ms"] * 100
+        print(f"baseline {baseline['total_ms']:.1f} ms -> {results['total_ms']:.1f} ms ({change:+.1f}%)")
+        if change > args.max_regression:
+            print(f"Import time regressed by more than {args.max_regression:.0f}%")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
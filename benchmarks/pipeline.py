@@ -0,0 +1,322 @@
+"""End-to-end synthetic-load benchmark for the statement pipeline.
+
+Seeds the statements table with generated history, drops the final month's
+statement into the ingestion bucket and drives lambda_handler with an S3
+event, all against in-memory stand-ins (or moto with --moto), so it runs
+offline. Each pipeline stage is wrapped to record calls and wall time, and a
+second, traced run records the peak Python allocation while each stage is
+active. Results can be saved and compared between commits:
+
+    python benchmarks/pipeline.py --users 50 --months 12 --per-month 40 --json before.json
+    python benchmarks/pipeline.py --users 50 --months 12 --per-month 40 --baseline before.json
+
+Stage times are inclusive (the chart generators also count towards
+build_user_report) and are summed over threads. Rendering runs inline by
+default; with --workers > 1 the render stages run in child processes and
+are not broken down.
+"""
+import argparse
+import contextlib
+import functools
+import inspect
+import io
+import json
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "docker"))
+sys.path.insert(0, BENCHMARK_DIR)
+os.environ.setdefault("AWS_DEFAULT_REGION", "ca-central-1")
+
+import lambda_function  # noqa: E402
+import standins  # noqa: E402
+import synthetic  # noqa: E402
+
+INGEST_BUCKET = "cpsc436c-g9-statement-ingestion"
+STATEMENT_KEY = "benchmark/statement.csv"
+
+# (label, owner, attribute). Run with HISTORY_SOURCE=rollups to read the
+# history from rollup items.
+STAGES = [
+    ("iter_statement_groups", lambda_function, "iter_statement_groups"),
+    ("query_historical_data", lambda_function, "query_historical_data"),
+    ("query_rollups", lambda_function, "query_rollups"),
+    ("summarize_transactions", lambda_function, "summarize_transactions"),
+    ("merge_summaries", lambda_function, "merge_summaries"),
+    ("report_digest", lambda_function, "report_digest"),
+    ("report_is_current", lambda_function, "report_is_current"),
+    ("build_user_report", lambda_function, "build_user_report"),
+    ("TransactionBatch", lambda_function.TransactionBatch, "__init__"),
+    ("summary_average", lambda_function, "summary_average"),
+    ("spending_by_category", lambda_function.TransactionBatch, "spending_by_category"),
+    ("recurring_cents", lambda_function.TransactionBatch, "recurring_cents"),
+    ("spending_trend", lambda_function, "spending_trend"),
+    ("summary_home_country", lambda_function, "summary_home_country"),
+    ("score_risk", lambda_function, "score_risk"),
+    ("high_value_records", lambda_function, "high_value_records"),
+    ("generate_pie_chart", lambda_function, "generate_pie_chart"),
+    ("generate_bar_line_chart", lambda_function, "generate_bar_line_chart"),
+    ("generate_recurring_transactions_graph", lambda_function, "generate_recurring_transactions_graph"),
+    ("generate_pdf_report", lambda_function, "generate_pdf_report"),
+    ("upload_to_s3", lambda_function, "upload_to_s3"),
+    ("batch_write_items", lambda_function, "batch_write_items"),
+    ("transact_heads", lambda_function, "transact_heads"),
+]
+
+
+class StageRecorder:
+    """Counts calls and wall time per stage, plus peak traced memory when tracing."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.peak_bytes = defaultdict(int)
+        self.active = {}  # frame id -> [label, traced bytes at entry, peak seen]
+
+    def _observe(self):
+        # tracemalloc has a single peak, so it is folded into every open
+        # stage and reset whenever a stage starts or ends.
+        if tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            for frame in self.active.values():
+                frame[2] = max(frame[2], peak)
+            tracemalloc.reset_peak()
+
+    def enter(self, label):
+        with self.lock:
+            self._observe()
+            frame = [label, tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0, 0]
+            frame_id = object()
+            self.active[frame_id] = frame
+        return frame_id, time.perf_counter()
+
+    def exit(self, token):
+        frame_id, started = token
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self._observe()
+            label, start_bytes, peak = self.active.pop(frame_id)
+            self.calls[label] += 1
+            self.seconds[label] += elapsed
+            self.peak_bytes[label] = max(self.peak_bytes[label], peak - start_bytes)
+
+    def wrap(self, label, function):
+        if inspect.isgeneratorfunction(function):
+            # Time each step of a generator, not the time its consumer holds it.
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                iterator = function(*args, **kwargs)
+                while True:
+                    token = self.enter(label)
+                    try:
+                        value = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        self.exit(token)
+                    yield value
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            token = self.enter(label)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit(token)
+        return wrapper
+
+
+@contextlib.contextmanager
+def instrumented(recorder):
+    originals = [(owner, name, getattr(owner, name)) for _, owner, name in STAGES]
+    for (label, owner, name), (_, _, original) in zip(STAGES, originals):
+        setattr(owner, name, recorder.wrap(label, original))
+    try:
+        yield
+    finally:
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+
+
+def prepare(args):
+    """Fresh stand-ins with the history seeded and the statement uploaded."""
+    s3_client, table = standins.install(
+        lambda_function,
+        s3_client=standins.FakeS3Client(args.latency_ms / 1000),
+        table=standins.FakeTable(lambda_function.TABLE_NAME, args.page_size, args.latency_ms / 1000),
+    )
+    lambda_function._report_cache.clear()
+    history = defaultdict(list)
+    statement = []
+    for user_id, year_month, transaction in synthetic.generate_transactions(
+        args.users, args.months, args.per_month, args.end_month, args.countries, args.recurring_share, args.seed,
+    ):
+        if year_month == args.end_month:
+            statement.append((user_id, year_month, transaction))
+        else:
+            history[(user_id, year_month)].append(transaction)
+    for (user_id, year_month), transactions in history.items():
+        for item in lambda_function.to_dynamo_items(user_id, year_month, transactions):
+            table.put_item(Item=item)
+    csv_file = io.StringIO()
+    synthetic.write_statement_csv(csv_file, statement)
+    s3_client.put_object(Bucket=INGEST_BUCKET, Key=STATEMENT_KEY, Body=csv_file.getvalue())
+    return s3_client, table
+
+
+def s3_event(bucket, key):
+    return {"Records": [{"eventSource": "aws:s3", "s3": {"bucket": {"name": bucket}, "object": {"key": key}}}]}
+
+
+def run_once(args, recorder, trace=False):
+    prepare(args)
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with instrumented(recorder), output:
+        if trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            response = lambda_function.lambda_handler(s3_event(INGEST_BUCKET, STATEMENT_KEY), None)
+        finally:
+            elapsed = time.perf_counter() - started
+            if trace:
+                tracemalloc.stop()
+    if response["statusCode"] != 200:
+        raise RuntimeError(f"lambda_handler failed: {response['body']}")
+    return elapsed
+
+
+@contextlib.contextmanager
+def moto_backend():
+    # Real boto3 clients against moto's in-process AWS; slower than the
+    # in-memory stand-ins but exercises the actual request serialization.
+    import boto3
+    from moto import mock_aws
+
+    with mock_aws():
+        boto3.client("s3").create_bucket(
+            Bucket=INGEST_BUCKET, CreateBucketConfiguration={"LocationConstraint": "ca-central-1"})
+        boto3.client("s3").create_bucket(
+            Bucket=lambda_function.REPORTS_BUCKET, CreateBucketConfiguration={"LocationConstraint": "ca-central-1"})
+        boto3.client("dynamodb", region_name="ca-central-1").create_table(
+            TableName=lambda_function.TABLE_NAME,
+            KeySchema=[{"AttributeName": "UserId", "KeyType": "HASH"}, {"AttributeName": "YearMonth", "KeyType": "RANGE"}],
+            AttributeDefinitions=[{"AttributeName": "UserId", "AttributeType": "S"},
+                                  {"AttributeName": "YearMonth", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        s3_client = boto3.client("s3")
+        table = boto3.resource("dynamodb", region_name="ca-central-1").Table(lambda_function.TABLE_NAME)
+        original = standins.install
+
+        def install(module, **standins):  # the moto clients stand in instead
+            module._s3_client, module._table = s3_client, table
+            return s3_client, table
+
+        standins.install = install
+        try:
+            yield
+        finally:
+            standins.install = original
+
+
+def measure(args):
+    lambda_function.RenderPool.__init__.__defaults__ = (args.workers,)
+    with moto_backend() if args.moto else contextlib.nullcontext():
+        for _ in range(args.warmup):
+            run_once(args, StageRecorder())
+        totals = []
+        recorders = []
+        for _ in range(args.runs):
+            recorder = StageRecorder()
+            totals.append(run_once(args, recorder))
+            recorders.append(recorder)
+        traced = StageRecorder()
+        if not args.no_memory:
+            run_once(args, traced, trace=True)
+
+    transactions = args.users * args.per_month
+    total = statistics.median(totals)
+    stages = {}
+    for label, _, _ in STAGES:
+        if not recorders[0].calls.get(label):
+            continue
+        stages[label] = {
+            "calls": recorders[0].calls[label],
+            "ms": statistics.median(recorder.seconds[label] for recorder in recorders) * 1000,
+            "peak_kb": traced.peak_bytes.get(label, 0) / 1024,
+        }
+    return {
+        "config": {key: getattr(args, key) for key in (
+            "users", "months", "per_month", "end_month", "countries", "recurring_share", "seed", "workers", "moto",
+            "latency_ms")},
+        "runs": args.runs,
+        "total_ms": total * 1000,
+        "statements_per_s": args.users / total,
+        "transactions_per_s": transactions / total,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": stages,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    synthetic.add_arguments(parser)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs first (imports, chart templates)")
+    parser.add_argument("--workers", type=int, default=1, help="render worker processes")
+    parser.add_argument("--page-size", type=int, default=100, help="items per stand-in query page")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated round trip per stand-in request")
+    parser.add_argument("--moto", action="store_true", help="use moto instead of the in-memory stand-ins")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--verbose", action="store_true", help="show the Lambda's own output")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file from an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=20.0,
+                        help="percent the total may grow over the baseline before failing")
+    args = parser.parse_args(argv)
+
+    results = measure(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    print(f"{args.users} statements x {args.per_month} transactions, {args.months - 1} months of history: "
+          f"{results['total_ms']:.1f} ms (median of {results['runs']} runs)")
+    print(f"  {results['statements_per_s']:.1f} statements/s, {results['transactions_per_s']:.0f} transactions/s, "
+          f"peak RSS {results['peak_rss_mb']:.0f} MB")
+    print(f"  {'stage':<38} {'calls':>6} {'ms':>10} {'peak KB':>10}" + ("  vs baseline" if baseline else ""))
+    for label, stage in results["stages"].items():
+        line = f"  {label:<38} {stage['calls']:>6} {stage['ms']:>10.1f} {stage['peak_kb']:>10.0f}"
+        before = baseline["stages"].get(label) if baseline else None
+        if before and before["ms"]:
+            line += f"  {(stage['ms'] - before['ms']) / before['ms'] * 100:+.1f}%"
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if baseline:
+        if baseline["config"] != results["config"]:
+            print("Warning: baseline was recorded with a different configuration")
+        change = (results["total_ms"] - baseline["total_ms"]) / baseline["total_ms"] * 100
+        print(f"baseline {baseline['total_ms']:.1f} ms -> {results['total_ms']:.1f} ms ({change:+.1f}%)")
+        if change > args.max_regression:
+            print(f"Pipeline time regressed by more than {args.max_regression:.0f}%")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+"""In-memory stand-ins for the S3 client, the statements table and Lambda.
+
+They implement just the calls lambda_function makes, with the same request
+and response shapes as boto3 (including ClientError for missing objects and
+LastEvaluatedKey paging), so the pipeline can run on a laptop with no
+network. Lambda invocations (of shard workers) run in-process. install()
+swaps them into a loaded lambda_function module. A latency (seconds per
+request) can be set to model network round trips.
+"""
+import copy
+import io
+import json
+import re
+import time
+
+from botocore.exceptions import ClientError
+
+
+def client_error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class StreamingBody(io.BytesIO):
+    pass
+
+
+class FakeS3Client:
+    def __init__(self, latency=0.0):
+        self.buckets = {}
+        self.latency = latency
+
+    def _round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _bucket(self, name):
+        return self.buckets.setdefault(name, {})
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, ContentType=None):
+        data = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        self._bucket(Bucket)[Key] = (data, dict(Metadata or {}))
+        return {}
+
+    def get_object(self, Bucket, Key):
+        self._round_trip()
+        try:
+            data, metadata = self._bucket(Bucket)[Key]
+        except KeyError:
+            raise client_error("NoSuchKey", "The specified key does not exist.", "GetObject")
+        return {"Body": StreamingBody(data), "ContentLength": len(data), "Metadata": dict(metadata)}
+
+    def head_object(self, Bucket, Key):
+        self._round_trip()
+        try:
+            data, metadata = self._bucket(Bucket)[Key]
+        except KeyError:
+            raise client_error("404", "Not Found", "HeadObject")
+        return {"ContentLength": len(data), "Metadata": dict(metadata)}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self._round_trip()
+        extra_args = ExtraArgs or {}
+        self.put_object(Bucket, Key, Fileobj.read(), extra_args.get("Metadata"), extra_args.get("ContentType"))
+
+    def delete_object(self, Bucket, Key):
+        self._bucket(Bucket).pop(Key, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix=""):
+        keys = sorted(key for key in self._bucket(Bucket) if key.startswith(Prefix))
+        contents = [{"Key": key, "Size": len(self._bucket(Bucket)[key][0])} for key in keys]
+        return {"Contents": contents, "KeyCount": len(contents), "IsTruncated": False}
+
+
+def evaluate_condition(condition, item):
+    # Evaluates the boto3.dynamodb.conditions objects the Lambda builds.
+    expression = condition.get_expression()
+    operator, values = expression["operator"], expression["values"]
+    if operator == "AND":
+        return all(evaluate_condition(value, item) for value in values)
+    if operator == "OR":
+        return any(evaluate_condition(value, item) for value in values)
+    if operator == "NOT":
+        return not evaluate_condition(values[0], item)
+    if operator == "attribute_not_exists":
+        return values[0].name not in item
+    if operator == "attribute_exists":
+        return values[0].name in item
+    value = item.get(values[0].name)
+    if operator == "=":
+        return value == values[1]
+    if operator == "<>":
+        return value != values[1]
+    if value is None:
+        return False
+    if operator == "BETWEEN":
+        return values[1] <= value <= values[2]
+    if operator == "<":
+        return value < values[1]
+    if operator == "<=":
+        return value <= values[1]
+    if operator == ">":
+        return value > values[1]
+    if operator == ">=":
+        return value >= values[1]
+    if operator == "begins_with":
+        return value.startswith(values[1])
+    raise NotImplementedError(f"Condition operator {operator} is not supported by the stand-in")
+
+
+def evaluate_expression(request, item):
+    # Evaluates the ConditionExpression strings the Lambda writes out itself
+    # (see revision_condition): attribute_not_exists(a) and a = :v.
+    expression = request.get("ConditionExpression")
+    if expression is None:
+        return True
+    names = request.get("ExpressionAttributeNames", {})
+    values = request.get("ExpressionAttributeValues", {})
+    match = re.fullmatch(r"attribute_not_exists\((#?\w+)\)", expression)
+    if match:
+        return names.get(match[1], match[1]) not in item
+    match = re.fullmatch(r"(#?\w+) = (:\w+)", expression)
+    if match:
+        return item.get(names.get(match[1], match[1])) == values[match[2]]
+    raise NotImplementedError(f"Condition {expression} is not supported by the stand-in")
+
+
+class FakeDynamoClient:
+    # Mirrors the high-level (resource) client: Python values in and out.
+    def __init__(self, table):
+        self.table = table
+
+    def query(self, TableName, KeyConditionExpression, ProjectionExpression=None,
+              ExpressionAttributeNames=None, ExclusiveStartKey=None, Limit=None):
+        self.table.round_trip()
+        items = [item for item in self.table.sorted_items() if evaluate_condition(KeyConditionExpression, item)]
+        if ExclusiveStartKey:
+            start = (ExclusiveStartKey["UserId"], ExclusiveStartKey["YearMonth"])
+            items = [item for item in items if (item["UserId"], item["YearMonth"]) > start]
+        limit = Limit or self.table.page_size
+        page, rest = items[:limit], items[limit:]
+        if ProjectionExpression:
+            names = ExpressionAttributeNames or {}
+            attributes = [names.get(name.strip(), name.strip()) for name in ProjectionExpression.split(",")]
+            page = [{name: item[name] for name in attributes if name in item} for item in page]
+        response = {"Items": copy.deepcopy(page), "Count": len(page)}
+        if rest:
+            last = items[limit - 1]
+            response["LastEvaluatedKey"] = {"UserId": last["UserId"], "YearMonth": last["YearMonth"]}
+        return response
+
+    def transact_write_items(self, TransactItems):
+        # Puts only, all or nothing, with a cancellation reason per item.
+        self.table.round_trip()
+        puts = [request["Put"] for request in TransactItems]
+        reasons = [
+            {"Code": "None"} if evaluate_expression(put, self.table.items.get(self.table.key_of(put["Item"]), {}))
+            else {"Code": "ConditionalCheckFailed", "Message": "The conditional request failed"}
+            for put in puts
+        ]
+        if any(reason["Code"] != "None" for reason in reasons):
+            error = client_error("TransactionCanceledException", "Transaction cancelled", "TransactWriteItems")
+            error.response["CancellationReasons"] = reasons
+            raise error
+        for put in puts:
+            self.table.put_item(Item=put["Item"])
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues="NONE"):
+        # "SET a = :v" and "ADD a :set", the forms the Lambda uses.
+        self.table.round_trip()
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        match = re.fullmatch(r"(SET|ADD) (#?\w+)(?: =)? (:\w+)", UpdateExpression)
+        if not match:
+            raise NotImplementedError(f"Update {UpdateExpression} is not supported by the stand-in")
+        key = self.table.key_of(Key)
+        old = copy.deepcopy(self.table.items.get(key))
+        item = self.table.items.setdefault(key, dict(Key))
+        name, value = names.get(match[2], match[2]), copy.deepcopy(values[match[3]])
+        item[name] = value if match[1] == "SET" else item.get(name, type(value)()) | value
+        return {"Attributes": old} if ReturnValues == "ALL_OLD" and old else {}
+
+    def delete_item(self, TableName, Key):
+        self.table.round_trip()
+        self.table.items.pop(self.table.key_of(Key), None)
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        self.table.round_trip()
+        for request in RequestItems.get(self.table.name, []):
+            if "DeleteRequest" in request:
+                self.table.items.pop(self.table.key_of(request["DeleteRequest"]["Key"]), None)
+            else:
+                self.table.put_item(Item=request["PutRequest"]["Item"])
+        return {"UnprocessedItems": {}}
+
+
+class FakeMeta:
+    def __init__(self, client):
+        self.client = client
+
+
+class FakeTable:
+    """A (UserId, YearMonth) keyed table. page_size caps items per query page."""
+
+    def __init__(self, name="cpsc436c-g9-statements", page_size=100, latency=0.0):
+        self.name = name
+        self.page_size = page_size
+        self.latency = latency
+        self.items = {}
+        self.meta = FakeMeta(FakeDynamoClient(self))
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def key_of(self, item):
+        return item["UserId"], item["YearMonth"]
+
+    def sorted_items(self):
+        return [self.items[key] for key in sorted(self.items)]
+
+    def put_item(self, Item, **kwargs):
+        self.items[self.key_of(Item)] = copy.deepcopy(Item)
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get(self.key_of(Key))
+        return {"Item": copy.deepcopy(item)} if item is not None else {}
+
+
+class FakeLambdaClient:
+    """Runs invocations synchronously in this process by calling handler.
+
+    An "Event" invocation is retried twice when it raises, as Lambda retries
+    asynchronous invocations, and its result is dropped.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.invocations = 0
+
+    def invoke(self, FunctionName, Payload, InvocationType="RequestResponse"):
+        self.invocations += 1
+        if InvocationType == "Event":
+            for _ in range(3):
+                try:
+                    self.handler(json.loads(Payload), None)
+                    break
+                except Exception:
+                    pass
+            return {"StatusCode": 202, "Payload": StreamingBody(b"")}
+        try:
+            result, error = self.handler(json.loads(Payload), None), None
+        except Exception as e:
+            result, error = {"errorMessage": str(e), "errorType": type(e).__name__}, "Unhandled"
+        response = {"StatusCode": 200, "Payload": StreamingBody(json.dumps(result).encode("utf-8"))}
+        if error:
+            response["FunctionError"] = error
+        return response
+
+
+def install(module, s3_client=None, table=None, lambda_client=None):
+    """Point a loaded lambda_function module at the stand-ins."""
+    s3_client = s3_client or FakeS3Client()
+    table = table or FakeTable(module.TABLE_NAME)
+    module._s3_client = s3_client
+    module._table = table
+    module._lambda_client = lambda_client or FakeLambdaClient(module.lambda_handler)
+    return s3_client, table
@@ -0,0 +1,126 @@
+"""Synthetic statement generator for benchmarking the pipeline.
+
+Produces transactions in the shape the Lambda works with (the statement CSV
+columns, or the transaction dicts stored in DynamoDB) for a configurable
+number of users, months and transactions per month, country mix and share
+of recurring charges. Output is deterministic for a given seed.
+
+    python benchmarks/synthetic.py --users 100 --months 12 --per-month 40 > statement.csv
+"""
+import argparse
+import csv
+import random
+import sys
+from decimal import Decimal
+
+CSV_COLUMNS = [
+    "UserId", "YearMonth", "transactions.id", "transactions.date", "transactions.vendor",
+    "transactions.category", "transactions.amount", "transactions.currency",
+    "transactions.recurring", "transactions.type", "transactions.location",
+    "transactions.description",
+]
+
+CATEGORIES = {
+    "Groceries": ["Walmart", "Whole Foods", "Costco", "Safeway", "Save-On-Foods"],
+    "Shopping": ["Amazon", "Best Buy", "IKEA", "Apple Store", "Target"],
+    "Food & Beverages": ["Starbucks", "Tim Hortons", "McDonald's", "Subway", "Chipotle"],
+    "Entertainment": ["Cineplex", "Steam", "Ticketmaster", "Spotify", "Netflix"],
+    "Travel": ["Air Canada", "Uber", "Expedia", "Marriott", "Via Rail"],
+    "Health & Wellness": ["Shoppers Drug Mart", "Gym Membership", "Dental Clinic"],
+}
+RECURRING = [
+    ("Netflix", "Entertainment", "13.99"),
+    ("Spotify", "Entertainment", "9.99"),
+    ("Gym Membership", "Health & Wellness", "55.00"),
+    ("Apple.com/Bill", "Shopping", "3.35"),
+    ("Fido Mobile", "Shopping", "50.40"),
+]
+CURRENCIES = {"US": "USD", "CA": "CAD", "FR": "EUR", "GB": "GBP", "MX": "MXN", "JP": "JPY"}
+
+
+def parse_country_mix(spec):
+    # "CA:0.8,US:0.15,FR:0.05" -> ([countries], [weights])
+    countries, weights = [], []
+    for entry in spec.split(","):
+        country, _, weight = entry.strip().partition(":")
+        countries.append(country.upper())
+        weights.append(float(weight or 1))
+    return countries, weights
+
+
+def month_sequence(end_year_month, months):
+    year, month = int(end_year_month[:4]), int(end_year_month[4:])
+    sequence = []
+    for _ in range(months):
+        sequence.append(f"{year}{month:02d}")
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return sequence[::-1]
+
+
+def generate_transactions(users=10, months=12, per_month=30, end_year_month="202412",
+                          country_mix="CA:0.8,US:0.15,FR:0.05", recurring_share=0.2, seed=0):
+    """Yield (user_id, year_month, transaction) in statement order."""
+    rng = random.Random(seed)
+    countries, weights = parse_country_mix(country_mix)
+    categories = list(CATEGORIES)
+    for user in range(1, users + 1):
+        user_id = str(user)
+        home = rng.choices(countries, weights)[0]
+        subscriptions = rng.sample(RECURRING, k=rng.randint(1, len(RECURRING)))
+        for year_month in month_sequence(end_year_month, months):
+            for sequence in range(per_month):
+                day = rng.randint(1, 28)
+                if rng.random() < recurring_share:
+                    vendor, category, amount = rng.choice(subscriptions)
+                    amount, recurring, kind, country = Decimal(amount), True, "subscription", home
+                else:
+                    category = rng.choice(categories)
+                    vendor = rng.choice(CATEGORIES[category])
+                    amount = Decimal(rng.lognormvariate(3.5, 1.0)).quantize(Decimal("0.01"))
+                    recurring, kind = False, "purchase"
+                    country = rng.choices(countries, weights)[0]
+                yield user_id, year_month, {
+                    "amount": amount,
+                    "category": category,
+                    "currency": CURRENCIES.get(country, "USD"),
+                    "date": f"{year_month[:4]}-{year_month[4:]}-{day:02d}",
+                    "description": f"{vendor} {kind}",
+                    "id": f"{user_id}-{year_month}-{sequence:05d}",
+                    "location": f"{country}-{rng.randint(1, 9):02d}",
+                    "recurring": recurring,
+                    "type": kind,
+                    "vendor": vendor,
+                }
+
+
+def write_statement_csv(file, transactions):
+    writer = csv.writer(file)
+    writer.writerow(CSV_COLUMNS)
+    for user_id, year_month, t in transactions:
+        writer.writerow([
+            user_id, year_month, t["id"], t["date"], t["vendor"], t["category"], str(t["amount"]),
+            t["currency"], "true" if t["recurring"] else "false", t["type"], t["location"], t["description"],
+        ])
+
+
+def add_arguments(parser):
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--months", type=int, default=12, help="months per user, including the statement month")
+    parser.add_argument("--per-month", type=int, default=30, help="transactions per user per month")
+    parser.add_argument("--end-month", default="202412", help="statement month (YYYYMM)")
+    parser.add_argument("--countries", default="CA:0.8,US:0.15,FR:0.05", help="country mix as CC:weight,...")
+    parser.add_argument("--recurring-share", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    write_statement_csv(sys.stdout, generate_transactions(
+        args.users, args.months, args.per_month, args.end_month, args.countries, args.recurring_share, args.seed,
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""Batch ingestion and report regeneration outside of the S3 trigger.
+
+Runs statements from a local directory or an S3 prefix through the same
+pipeline as lambda_handler (without deleting them), and re-renders the
+reports of (UserId, YearMonth) keys from what is already stored, e.g. after
+a change to the analysis:
+
+    python backfill.py --dir statements/ --checkpoint run.ckpt
+    python backfill.py --s3 s3://cpsc436c-g9-ingest/2025/ --workers 8
+    python backfill.py --keys keys.txt --force --checkpoint regen.ckpt
+    python backfill.py --rollups 1 --rollups 2
+
+Keys are read one per line as USERID:YYYYMM. --rollups rewrites the monthly
+rollups of a user from the stored months, e.g. for months written before
+rollups existed. Every finished statement file
+and key is appended to the checkpoint, so rerunning the same command after
+an interruption skips the work already done. --local runs against the
+in-memory stand-ins from benchmarks/ instead of AWS, with --local-state
+keeping them between runs and --output writing out the rendered reports.
+With --export-bucket (or EXPORT_BUCKET) the results are also exported as
+columnar files, a set per statement or batch of keys.
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import lambda_function as lf
+
+KEY_BATCH_SIZE = 50
+
+
+class Checkpoint:
+    # Append-only JSON lines of {"unit", "status", "error"}; the last line
+    # written for a unit wins.
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line of an interrupted run
+                    if entry["status"] == "done":
+                        self.done.add(entry["unit"])
+                    else:
+                        self.done.discard(entry["unit"])
+
+    def record(self, units, error=None):
+        with self.lock:
+            if error is None:
+                self.done.update(units)
+            if not self.path:
+                return
+            with open(self.path, "a") as f:
+                for unit in units:
+                    f.write(json.dumps({"unit": unit, "status": "failed" if error else "done", "error": error}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def directory_statements(directory):
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(".csv"):
+            yield os.path.join(directory, name)
+
+
+def s3_statements(url):
+    parsed = urlparse(url)
+    request = {"Bucket": parsed.netloc, "Prefix": parsed.path.lstrip("/")}
+    while True:
+        response = lf.get_s3_client().list_objects_v2(**request)
+        for obj in response.get("Contents", []):
+            if obj["Key"].lower().endswith(".csv"):
+                yield f"s3://{parsed.netloc}/{obj['Key']}"
+        if not response.get("IsTruncated"):
+            return
+        request["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def read_keys(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield parse_key(line)
+
+
+def parse_key(text):
+    user_id, _, year_month = text.partition(":")
+    if not user_id or len(year_month) != 6 or not year_month.isdigit():
+        raise argparse.ArgumentTypeError(f"Expected USERID:YYYYMM, got {text!r}")
+    return user_id, year_month
+
+
+def stored_groups(keys):
+    # Feeds stored months back through the pipeline as if they were a
+    # statement; the merge finds nothing new, so only the report is redone.
+    for key in keys:
+        transactions, _, _ = lf.query_month(*key)
+        if transactions is None:
+            print(f"No stored transactions for UserId {key[0]} YearMonth {key[1]}; skipping")
+            continue
+        yield key, transactions
+
+
+def run_statement(source, pool, force, exporter):
+    if source.startswith("s3://"):
+        parsed = urlparse(source)
+        return lf.process_statement(parsed.netloc, parsed.path.lstrip("/"), pool, delete=False, force=force, exporter=exporter)
+    with open(source, encoding="utf-8-sig", newline="") as f:
+        groups = lf.iter_statement_groups(f)
+        return lf.process_statement(None, source, pool, groups=groups, delete=False, force=force, exporter=exporter)
+
+
+def run_keys(keys, pool, force, exporter):
+    return lf.process_statement(
+        None, "stored months", pool, groups=stored_groups(keys), delete=False, force=force, exporter=exporter
+    )
+
+
+def run_rollups(user_id, pool, force, exporter):
+    failures = lf.backfill_rollups(user_id)
+    if failures:
+        return f"Failed to write {len(failures)} rollup items: {failures[0]['error']}"
+    return None
+
+
+def work_units(args, checkpoint):
+    # (checkpoint units, function, args) in the order they are run.
+    statements = []
+    for directory in args.dir:
+        statements.extend(directory_statements(directory))
+    for url in args.s3:
+        statements.extend(s3_statements(url))
+    for source in statements:
+        if source not in checkpoint.done:
+            yield [source], run_statement, (source,)
+    keys = list(args.key)
+    for path in args.keys:
+        keys.extend(read_keys(path))
+    keys = [key for key in dict.fromkeys(keys) if f"{key[0]}:{key[1]}" not in checkpoint.done]
+    for start in range(0, len(keys), args.batch_size):
+        batch = keys[start:start + args.batch_size]
+        yield [f"{user_id}:{year_month}" for user_id, year_month in batch], run_keys, (batch,)
+    for user_id in dict.fromkeys(args.rollups):
+        if f"rollups:{user_id}" not in checkpoint.done:
+            yield [f"rollups:{user_id}"], run_rollups, (user_id,)
+
+
+def use_local_stand_ins(state_path):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+    import standins
+
+    s3_client, table = standins.install(lf)
+    if state_path and os.path.exists(state_path):
+        with open(state_path, "rb") as f:
+            s3_client.buckets, table.items = pickle.load(f)
+    return s3_client, table
+
+
+def save_local_state(state_path, s3_client, table):
+    with open(state_path + ".tmp", "wb") as f:
+        pickle.dump((s3_client.buckets, table.items), f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def write_reports(s3_client, output, export_bucket):
+    os.makedirs(output, exist_ok=True)
+    for bucket in filter(None, (lf.REPORTS_BUCKET, export_bucket)):
+        for key, (data, _) in s3_client.buckets.get(bucket, {}).items():
+            path = os.path.join(output, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", action="append", default=[], help="directory of statement CSVs")
+    parser.add_argument("--s3", action="append", default=[], help="s3://bucket/prefix of statement CSVs")
+    parser.add_argument("--keys", action="append", default=[], help="file of USERID:YYYYMM keys to re-render")
+    parser.add_argument("--key", action="append", default=[], type=parse_key, help="a USERID:YYYYMM key to re-render")
+    parser.add_argument("--rollups", action="append", default=[], metavar="USERID", help="a user whose rollups to rebuild")
+    parser.add_argument("--checkpoint", help="progress file; rerun with it to resume")
+    parser.add_argument("--workers", type=int, default=lf.RENDER_WORKERS, help="render worker processes")
+    parser.add_argument("--concurrency", type=int, default=lf.MAX_CONCURRENT_RECORDS, help="statements processed at once")
+    parser.add_argument("--batch-size", type=int, default=KEY_BATCH_SIZE, help="keys per checkpointed batch")
+    parser.add_argument("--force", action="store_true", help="render even when the stored report is current")
+    parser.add_argument("--local", action="store_true", help="use in-memory S3 and DynamoDB stand-ins")
+    parser.add_argument("--local-state", help="with --local, file the stand-ins are loaded from and saved to")
+    parser.add_argument("--export-bucket", default=lf.EXPORT_BUCKET, help="bucket for the columnar export of the results")
+    parser.add_argument("--output", help="with --local, directory to write the reports and export buckets to")
+    args = parser.parse_args(argv)
+    if not (args.dir or args.s3 or args.keys or args.key or args.rollups):
+        parser.error("nothing to do: give --dir, --s3, --keys, --key or --rollups")
+    if (args.local_state or args.output) and not args.local:
+        parser.error("--local-state and --output need --local")
+
+    local = use_local_stand_ins(args.local_state) if args.local else None
+    checkpoint = Checkpoint(args.checkpoint)
+    run_id = f"backfill-{os.getpid()}-{int(time.time())}"
+    failed = 0
+    try:
+        units = work_units(args, checkpoint)
+        with lf.RenderPool(args.workers) as pool:
+            def run(unit, number):
+                # Each unit exports its own files before it is checkpointed.
+                names, function, function_args = unit
+                exporter = lf.ResultExporter(f"{run_id}-{number:06d}", args.export_bucket) if args.export_bucket else None
+                error = function(*function_args, pool, args.force, exporter)
+                if exporter and not exporter.flush():
+                    error = error or "Failed to upload the export."
+                checkpoint.record(names, error)
+                print(f"{'Failed' if error else 'Done'}: {names[0]}{f' (+{len(names) - 1})' if len(names) > 1 else ''}{f': {error}' if error else ''}")
+                return error
+
+            # Bounded so a long listing is not turned into futures all at once.
+            with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+                running = []
+                for number, unit in enumerate(units):
+                    running.append(executor.submit(run, unit, number))
+                    if len(running) >= 2 * args.concurrency:
+                        failed += bool(running.pop(0).result())
+                failed += sum(bool(future.result()) for future in running)
+    finally:
+        if local and args.local_state:
+            save_local_state(args.local_state, *local)
+        if local and args.output:
+            write_reports(local[0], args.output, args.export_bucket)
+    print(f"{failed} failed; rerun to retry them" if failed else "All done")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
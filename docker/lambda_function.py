@@ -1,265 +1,1077 @@
 import csv
 import boto3
 import os
+import sys
+import hashlib
+import io
 import json
+import math
+import multiprocessing
+import multiprocessing.connection
+import random
+import re
+import threading
+import time
+import uuid
+import tracemalloc
+import zlib
+from contextlib import contextmanager
 from decimal import Decimal
-from collections import Counter
+from urllib.parse import unquote_plus
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
-import pycountry
-import matplotlib.pyplot as plt
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.units import inch
-from fpdf import FPDF
-import matplotlib.pyplot as plt
 import numpy as np
-import matplotlib.cm as cm
 
+# matplotlib, fpdf and pycountry are imported where they are used and the AWS
+# clients are created on first use, so a cold start only pays for what the
+# invocation needs. The clients are reused across warm invocations.
+TABLE_NAME = "cpsc436c-g9-statements"
+_client_lock = threading.Lock()
+_s3_client = None
+_table = None
+_lambda_client = None
+
+def get_s3_client():
+    global _s3_client
+    with _client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3')
+    return _s3_client
+
+def get_table():
+    global _table
+    with _client_lock:
+        if _table is None:
+            _table = boto3.resource("dynamodb", region_name="ca-central-1").Table(TABLE_NAME)
+    return _table
+
+def get_lambda_client():
+    # Shard invocations wait for the worker, which can run for up to 15 minutes.
+    global _lambda_client
+    with _client_lock:
+        if _lambda_client is None:
+            from botocore.config import Config
+            _lambda_client = boto3.client("lambda", config=Config(read_timeout=900, retries={"max_attempts": 0}))
+    return _lambda_client
+
+def render_figure(figure):
+    # Rasterize on the Agg canvas and keep the pixels in memory, PNG "Up"
+    # filtered and Flate-compressed so the PDF can embed them as they are.
+    figure.canvas.draw()
+    pixels = np.asarray(figure.canvas.buffer_rgba())[:, :, :3]
+    height, width = pixels.shape[:2]
+    filtered = pixels.copy()
+    filtered[1:] -= pixels[:-1]
+    rows = np.hstack([np.full((height, 1), 2, dtype=np.uint8), filtered.reshape(height, width * 3)])
+    return {"kind": "raster", "width": width, "height": height, "data": zlib.compress(rows.tobytes(), 6)}
+
+def matplotlib_figure():
+    # MPLCONFIGDIR has to point somewhere writable before matplotlib is imported.
+    os.environ.setdefault("MPLCONFIGDIR", "/tmp")
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    return Figure, FigureCanvasAgg
+
+#### Metrics ####
+# Each stage of the pipeline runs under `with stage(name)`, which records wall
+# time, CPU time, bytes moved and (with METRICS_TRACE_MEMORY) the traced
+# allocation peak. Stages add up in the innermost metrics_scope of the thread,
+# a statement or one user's report, and the scope emits one CloudWatch
+# Embedded Metric Format line per stage when it closes. Stage is the only
+# dimension; the user goes in as a property so the metric count stays flat.
+# Lambda turns stdout lines into metrics; METRICS_SINK can instead name a
+# local file to append them to, or be "off".
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "StatementReports")
+METRICS_SINK = os.environ.get("METRICS_SINK", "stdout")
+METRICS_TRACE_MEMORY = os.environ.get("METRICS_TRACE_MEMORY", "false").lower() == "true"
+# Reports slower than this get their sampled stacks logged; 0 turns the sampler off.
+PROFILE_SLOW_REPORT_MS = float(os.environ.get("PROFILE_SLOW_REPORT_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_TOP_STACKS = int(os.environ.get("PROFILE_TOP_STACKS", "25"))
+_metrics_lock = threading.Lock()
+_metrics_state = threading.local()
+_memory_frames = {}
+
+def emit_metrics(record):
+    if METRICS_SINK == "off":
+        return
+    line = json.dumps(record, separators=(",", ":"), default=str)
+    with _metrics_lock:
+        if METRICS_SINK == "stdout":
+            print(line, flush=True)
+        else:
+            with open(METRICS_SINK, "a") as file:
+                file.write(line + "\n")
+
+class MetricsScope:
+    def __init__(self, **properties):
+        self.properties = properties
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, name, wall_time, cpu_time, size, peak):
+        with self.lock:
+            stats = self.stages.setdefault(name, [0, 0.0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += wall_time
+            stats[2] += cpu_time
+            stats[3] += size
+            stats[4] = max(stats[4], peak)
+
+    def flush(self):
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        timestamp = int(time.time() * 1000)
+        for name, (calls, wall_time, cpu_time, size, peak) in stages.items():
+            metrics = [
+                {"Name": "WallTime", "Unit": "Milliseconds"},
+                {"Name": "CpuTime", "Unit": "Milliseconds"},
+                {"Name": "Calls", "Unit": "Count"},
+            ]
+            record = {
+                "Stage": name,
+                "WallTime": round(wall_time * 1000, 3),
+                "CpuTime": round(cpu_time * 1000, 3),
+                "Calls": calls,
+                **self.properties,
+            }
+            if size:
+                metrics.append({"Name": "Bytes", "Unit": "Bytes"})
+                record["Bytes"] = size
+            if METRICS_TRACE_MEMORY:
+                metrics.append({"Name": "PeakMemory", "Unit": "Bytes"})
+                record["PeakMemory"] = peak
+            record["_aws"] = {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [["Stage"]], "Metrics": metrics}],
+            }
+            emit_metrics(record)
 
-s3_client = boto3.client('s3')
-dynamodb = boto3.resource("dynamodb", region_name="ca-central-1")
-table = dynamodb.Table("cpsc436c-g9-statements")
-
-def check_table_connection(table_name):
+@contextmanager
+def metrics_scope(**properties):
+    scope = MetricsScope(**properties)
+    scopes = _metrics_state.__dict__.setdefault("scopes", [])
+    scopes.append(scope)
     try:
-        table = dynamodb.Table(table_name)
-        response = table.table_status
-        print(f"Connection successful! Table '{table_name}' status: {response}")
-    except ClientError as e:
-        print(f"Error connecting to table '{table_name}': {e.response['Error']['Message']}")
-    except Exception as e:
-        print(f"An unexpected error occurred: {str(e)}")
-
-check_table_connection("cpsc436c-g9-statements")
-print(table.attribute_definitions)
-
-def query_historical_data(user_id):
+        yield scope
+    finally:
+        scopes.pop()
+        scope.flush()
+
+def current_scope():
+    scopes = getattr(_metrics_state, "scopes", None)
+    return scopes[-1] if scopes else None
+
+def _observe_memory():
+    # tracemalloc keeps a single peak, so it is folded into every open stage
+    # and reset whenever a stage starts or ends.
+    peak = tracemalloc.get_traced_memory()[1]
+    for frame in _memory_frames.values():
+        frame[1] = max(frame[1], peak)
+    tracemalloc.reset_peak()
+
+def memory_frame_enter():
+    with _metrics_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _observe_memory()
+        frame = [tracemalloc.get_traced_memory()[0], 0]
+        _memory_frames[id(frame)] = frame
+        return frame
+
+def memory_frame_exit(frame):
+    with _metrics_lock:
+        _observe_memory()
+        del _memory_frames[id(frame)]
+    return max(0, frame[1] - frame[0])
+
+class StageTimer:
+    def __init__(self):
+        self.bytes = 0
+
+@contextmanager
+def stage(name, scope=None):
+    # Stages outside any scope (e.g. on a helper thread) are emitted on their own.
+    scope = scope or current_scope()
+    timer = StageTimer()
+    frame = memory_frame_enter() if METRICS_TRACE_MEMORY else None
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
     try:
-        # Query the DynamoDB table for all YearMonths for the given UserId
-        response = table.query(
-            KeyConditionExpression=boto3.dynamodb.conditions.Key("UserId").eq(user_id)
-        )
-        
-        # Check if items are found
-        if "Items" in response:
-            all_historical_data = []
-            for item in response["Items"]:
-                all_historical_data.extend(item["transactions"])  # Combine transactions from all months
-            return all_historical_data
+        yield timer
+    finally:
+        wall_time, cpu_time = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+        peak = memory_frame_exit(frame) if frame else 0
+        if scope is None:
+            scope = MetricsScope()
+            scope.add(name, wall_time, cpu_time, timer.bytes, peak)
+            scope.flush()
         else:
-            print(f"No historical data found for UserId {user_id}")
-            return []
+            scope.add(name, wall_time, cpu_time, timer.bytes, peak)
+
+def response_bytes(response):
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    return int(headers.get("content-length", 0))
+
+class StackSampler:
+    # A sampling profiler for one thread: a daemon thread reads its Python
+    # stack every interval and counts the collapsed stacks (flamegraph.pl input).
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+@contextmanager
+def report_profiler(user_id, year_month):
+    if PROFILE_SLOW_REPORT_MS <= 0:
+        yield
+        return
+    sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+    sampler.thread.start()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        sampler.stopped.set()
+        sampler.thread.join()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms >= PROFILE_SLOW_REPORT_MS:
+            emit_metrics({
+                "Type": "Profile",
+                "UserId": user_id,
+                "YearMonth": year_month,
+                "WallTime": round(elapsed_ms, 3),
+                "IntervalMs": PROFILE_INTERVAL_MS,
+                "Samples": sampler.samples,
+                "Stacks": dict(sampler.stacks.most_common(PROFILE_TOP_STACKS)),
+            })
+
+# 0 keeps the full history for the historical average and home country.
+HISTORY_LOOKBACK_MONTHS = int(os.environ.get("HISTORY_LOOKBACK_MONTHS", "0"))
+HISTORY_PROJECTION = ("YearMonth", "transactions", "format", "chunks", "chunk_tag", "payload", "revision")
+# "rollups" builds the history from the per-month rollup items instead of the
+# transactions; switch only once backfill.py --rollups has covered older months.
+HISTORY_SOURCE = os.environ.get("HISTORY_SOURCE", "transactions")
+
+def shift_year_month(year_month, months):
+    total = int(year_month[:4]) * 12 + int(year_month[4:]) - 1 + months
+    return f"{total // 12}{total % 12 + 1:02d}"
+
+def history_window(year_month):
+    # The analyses need the previous month, the last three months and the
+    # current year; only months before the statement month count as history.
+    end_month = shift_year_month(year_month, -1)
+    if not HISTORY_LOOKBACK_MONTHS:
+        return None, end_month
+    start_month = min(
+        f"{year_month[:4]}01",
+        shift_year_month(year_month, -3),
+        shift_year_month(year_month, -HISTORY_LOOKBACK_MONTHS),
+    )
+    return start_month, end_month
+
+def query_items(key_condition, projection=None):
+    table = get_table()
+    query_kwargs = {"TableName": table.name, "KeyConditionExpression": key_condition}
+    if projection:
+        names = {f"#p{i}": name for i, name in enumerate(projection)}
+        query_kwargs["ProjectionExpression"] = ", ".join(names)
+        query_kwargs["ExpressionAttributeNames"] = names
+
+    items = []
+    # The client (unlike the Table resource) is thread-safe, and every page
+    # has to be followed or users with more than 1 MB of history get cut off.
+    while True:
+        with stage("history_query") as timer:
+            response = table.meta.client.query(**query_kwargs)
+            timer.bytes = response_bytes(response)
+        items.extend(response.get("Items", []))
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        if not last_evaluated_key:
+            return items
+        query_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+def month_key_condition(user_id, start_month=None, end_month=None):
+    # Overflow chunks of a compact month sort right after it ("202411#001"),
+    # so the upper bound has to take them in too. Rollup items ("ROLLUP#...")
+    # sort after every month and are never included.
+    end_month = (end_month or "999912") + CHUNK_SEPARATOR + "~"
+    if start_month:
+        return Key("UserId").eq(user_id) & Key("YearMonth").between(start_month, end_month)
+    return Key("UserId").eq(user_id) & Key("YearMonth").lte(end_month)
+
+def query_historical_data(user_id, start_month=None, end_month=None, projection=HISTORY_PROJECTION):
+    months = query_month_transactions(user_id, start_month, end_month, projection)
+    return [transaction for transactions in months.values() for transaction in transactions]  # Combine transactions from all months
+
+def query_month_transactions(user_id, start_month=None, end_month=None, projection=HISTORY_PROJECTION):
+    # {YearMonth: transactions} in month order.
+    try:
+        items = query_items(month_key_condition(user_id, start_month, end_month), projection)
     except ClientError as e:
         error_message = e.response["Error"]["Message"]
         print(f"Error querying DynamoDB: {error_message}")
-        return []
+        return {}
+    return month_transactions(items)
 
-def load_new_transactions(csv_path):
-    grouped_items = {}
+def query_rollups(user_id, start_month=None, end_month=None):
+    key_condition = Key("UserId").eq(user_id) & Key("YearMonth").between(
+        ROLLUP_PREFIX + (start_month or ""), ROLLUP_PREFIX + (end_month or "999912") + CHUNK_SEPARATOR + "~"
+    )
     try:
-        with open(csv_path, mode="r", encoding="utf-8-sig") as file:
-            csv_reader = csv.DictReader(file)
-            
-            # Process each row in the CSV file
-            for row in csv_reader:
-                transaction = {
-                    "id": row["transactions.id"],
-                    "date": row["transactions.date"],
-                    "vendor": row["transactions.vendor"],
-                    "category": row["transactions.category"],
-                    "amount": Decimal(row["transactions.amount"]),
-                    "currency": row["transactions.currency"],
-                    "recurring": row["transactions.recurring"].lower() == "true",
-                    "type": row["transactions.type"],
-                    "location": row["transactions.location"],
-                    "description": row["transactions.description"],
-                }
-                
-                key = (row["UserId"], row["YearMonth"])
-                if key not in grouped_items:
-                    grouped_items[key] = []
-                grouped_items[key].append(transaction)
-        print("Successfully loaded new transactions.")
-    except Exception as e:
-        print(f"Error loading new transactions: {str(e)}")
-    return grouped_items
-
-def calculate_historical_average(historical_data):
-    if historical_data:
-        total_spending = sum(float(item["amount"]) for item in historical_data)
-        average_spending = round((total_spending / len(historical_data)),2)
-        return average_spending
-    else:
-        return 0
-
-def determine_home_country(historical_data):
-    country_counts = {}
-   
-    for item in historical_data:
-        country_code = item["location"][:2]
-        country = pycountry.countries.get(alpha_2=country_code).name
-        if country in country_counts:
-            country_counts[country] += 1
-        else:
-            country_counts[country] = 1
-    
-    #  country with the highest count = home countery
-    max_count = 0
-    home_country = None
-    for country, count in country_counts.items():
-        if count > max_count:
-            max_count = count
-            home_country = country
-    
-    return home_country
-
-def flag_risky_transactions(current_transactions, home_country, historical_average):
-    flagged_transactions = []
-    for item in current_transactions: 
-        risk_level = None
-        loc = pycountry.countries.get(alpha_2=item["location"][:2]).name # loc of new transaction
-        if loc != home_country:
-            category = item["category"]
-            if float(item["amount"]) > historical_average:
-                risk_level = "High Risk"
-            else:
-                risk_level = "Moderate Risk"
-        
-        if risk_level:
-            flagged_transactions.append({
-                "transaction_id": item["id"],
-                "amount": float(item["amount"]),
-                "avarage_amount": historical_average,
-                "location": loc,
-                "risk_level": risk_level,
-                "home_counter": home_country,
-                "categoty": category,
-                'vendor': item["vendor"],
-                'date': item["date"]
-            })
-    return flagged_transactions
-
-def spending_by_category(current_transactions):
-    spending_by_category = {}
-    for transaction in current_transactions:
-        category = transaction["category"]
-        amount = round(float(transaction["amount"]), 2)
-        if category in spending_by_category:
-            spending_by_category[category] += round(amount, 2)
-        else:
-            spending_by_category[category] = round(amount, 2)
-    return spending_by_category
-
-def get_previous_month_data(all_transactions, current_year_month):
-    year = int(current_year_month[:4])
-    month = int(current_year_month[4:])
+        items = query_items(key_condition, ROLLUP_PROJECTION)
+    except ClientError as e:
+        print(f"Error querying DynamoDB: {e.response['Error']['Message']}")
+        return {}
+    return {year_month: summary for year_month, (summary, _, _, _) in read_rollups(items).items()}
+
+def query_history(user_id, year_month, source=HISTORY_SOURCE, statement_months=None):
+    # Summary of the history window before year_month that the report uses.
+    # statement_months ({YearMonth: (ids, summary, amounts)}, see
+    # prepare_report) are months of the statement being ingested, which may or
+    # may not be written yet; they stand in for the stored ones, so that the
+    # history does not depend on how far the writes have got.
+    start_month, end_month = history_window(year_month)
+    statement_months = {
+        month: record for month, record in (statement_months or {}).items()
+        if (start_month or "") <= month <= end_month
+    }
+    if source == "rollups":
+        summaries = query_rollups(user_id, start_month, end_month)
+        summaries.update((month, summary) for month, (_, summary, _) in statement_months.items())
+        return merge_summaries(summaries[month] for month in sorted(summaries) if summaries[month] is not None)
+    stored = query_month_transactions(user_id, start_month, end_month)
+    # Stored months are summarized a run at a time, between statement months.
+    summaries, amounts, run = [], [], []
+    for month in sorted(stored.keys() | statement_months.keys()):
+        if month not in statement_months:
+            run.extend(stored[month])
+            amounts.extend(float(t["amount"]) for t in stored[month])
+            continue
+        _, summary, month_amounts = statement_months[month]
+        if summary is None:
+            continue
+        if run:
+            summaries.append(summarize_transactions(run))
+            run = []
+        summaries.append(summary)
+        amounts.extend(month_amounts.tolist())
+    if run or not summaries:
+        summaries.append(summarize_transactions(run))
+    # A statement month's summary is also its rollup, so it is not modified.
+    history = dict(summaries[0]) if len(summaries) == 1 else merge_summaries(summaries)
+    if amounts:
+        # The average as the original report computed it, a float sum in
+        # month order; rollups only have the exact total (see summary_average).
+        history["average"] = round(sum(amounts) / len(amounts), 2)
+    return history
+
+STATEMENT_COLUMNS = (
+    "UserId",
+    "YearMonth",
+    "transactions.id",
+    "transactions.date",
+    "transactions.vendor",
+    "transactions.category",
+    "transactions.amount",
+    "transactions.currency",
+    "transactions.recurring",
+    "transactions.type",
+    "transactions.location",
+    "transactions.description",
+)
+
+def iter_statement_groups(lines):
+    # Rows of a statement must be grouped by (UserId, YearMonth) (see the
+    # README), so each group can be handed off as soon as the key changes and
+    # only one group has to be held in memory at a time.
+    csv_reader = csv.reader(lines)
+    header = next(csv_reader, None)
+    if header is None:
+        return
+    index = {name: position for position, name in enumerate(header)}
+    missing = [name for name in STATEMENT_COLUMNS if name not in index]
+    if missing:
+        raise ValueError(f"Statement is missing columns: {', '.join(missing)}")
+
+    (user_col, month_col, id_col, date_col, vendor_col, category_col, amount_col,
+     currency_col, recurring_col, type_col, location_col, description_col) = (
+        index[name] for name in STATEMENT_COLUMNS
+    )
 
-    if month == 1:  # January -> Go to December of the previous year
-        previous_year = year - 1
-        previous_month = 12
-    else:
-        previous_year = year
-        previous_month = month - 1
+    finished_keys = set()
+    current_key = None
+    transactions = []
+    for row in csv_reader:
+        if not row:
+            continue
+        key = (row[user_col], row[month_col])
+        if key != current_key:
+            if transactions:
+                yield current_key, transactions
+                finished_keys.add(current_key)
+            if key in finished_keys:
+                raise ValueError(f"Statement rows for UserId {key[0]} YearMonth {key[1]} are not contiguous; sort the statement by UserId and YearMonth")
+            current_key = key
+            transactions = []
+        transactions.append({
+            "amount": Decimal(row[amount_col]),
+            "category": row[category_col],
+            "currency": row[currency_col],
+            "date": row[date_col],
+            "description": row[description_col],
+            "id": row[id_col],
+            "location": row[location_col],
+            "recurring": row[recurring_col].lower() == "true",
+            "type": row[type_col],
+            "vendor": row[vendor_col],
+        })
+    if transactions:
+        yield current_key, transactions
+
+def stream_statement_groups(bucket_name, key):
+    # Read the object body incrementally instead of copying it to /tmp first.
+    # The body streams in while parsing, so "download" only covers the request
+    # and "parse" includes the reads.
+    with stage("download") as timer:
+        response = get_s3_client().get_object(Bucket=bucket_name, Key=key)
+        timer.bytes = response.get("ContentLength", 0)
+    # newline="" leaves line splitting to csv, which only breaks rows on \r and
+    # \n; a codecs reader would also break them on U+2028, \x85 and friends.
+    lines = io.TextIOWrapper(response["Body"], encoding="utf-8-sig", newline="")
+    groups = iter_statement_groups(lines)
+    while True:
+        with stage("parse"):
+            group = next(groups, None)
+        if group is None:
+            return
+        yield group
+
+class TransactionBatch:
+    # Columnar view of a list of transactions: amounts as integer cents, months
+    # as YYYYMM ints and dictionary-encoded text columns, so every aggregate is
+    # a vectorized pass instead of a loop over dicts.
+    def __init__(self, transactions):
+        self.transactions = transactions
+        self.size = len(transactions)
+        amounts = np.array([float(t["amount"]) for t in transactions], dtype=np.float64)
+        self.amount_cents = np.rint(amounts * 100).astype(np.int64)
+        months = np.array([t["date"] for t in transactions], dtype="U7").astype("datetime64[M]").astype(np.int64)
+        self.year = months // 12 + 1970
+        self.year_month = self.year * 100 + months % 12 + 1
+        self.recurring = np.array([bool(t["recurring"]) for t in transactions], dtype=bool)
+        self.category_codes, self.categories = encode_column([t["category"] for t in transactions])
+        self.vendor_codes, self.vendors = encode_column([t["vendor"] for t in transactions])
+        self.country_codes, self.countries = encode_column([t["location"][:2] for t in transactions])
+
+    def rows(self, start=0, stop=None):
+        return np.arange(start, self.size if stop is None else stop)
+
+    def grouped_cents(self, row_codes, labels, rows):
+        # Totals in cents per label, keyed in order of first appearance within rows.
+        if not len(rows):
+            return {}
+        totals = np.bincount(row_codes, weights=self.amount_cents[rows], minlength=len(labels))
+        present, first_seen = np.unique(row_codes, return_index=True)
+        return {labels[code]: int(totals[code]) for code in present[np.argsort(first_seen)]}
+
+    def category_cents(self, rows):
+        return self.grouped_cents(self.category_codes[rows], self.categories, rows)
+
+    def spending_by_category(self, rows):
+        return to_amounts(self.category_cents(rows))
+
+    def recurring_cents(self, rows, year):
+        rows = rows[self.recurring[rows] & (self.year[rows] == int(year))]
+        return self.grouped_cents(self.vendor_codes[rows], self.vendors, rows)
+
+    def monthly_cents(self, rows):
+        months, codes = np.unique(self.year_month[rows], return_inverse=True)
+        return self.grouped_cents(codes.ravel(), [str(month) for month in months], rows)
+
+    def days(self, rows):
+        # Dates as days since the epoch.
+        return np.array([self.transactions[row]["date"] for row in rows], dtype="datetime64[D]").astype(np.int64)
+
+    def rows_in_month(self, rows, year_month):
+        return rows[self.year_month[rows] == int(year_month)]
+
+    def rows_above(self, rows, threshold):
+        return rows[self.amount_cents[rows] / 100 > threshold]
+
+def encode_column(values):
+    # Dictionary-encode values; codes are assigned in order of first appearance.
+    index = {}
+    codes = np.fromiter((index.setdefault(value, len(index)) for value in values), dtype=np.int64, count=len(values))
+    return codes, list(index)
+
+def to_amounts(totals):
+    return {label: cents / 100 for label, cents in totals.items()}
+
+def add_cents(*totals):
+    # Sums cent totals, keeping the order in which labels first appear.
+    combined = {}
+    for total in totals:
+        for label, cents in total.items():
+            combined[label] = combined.get(label, 0) + cents
+    return combined
+
+#### History summaries ####
+# The report only needs a handful of aggregates from the history: the count,
+# sum and sum of squares of the amounts, totals per month, per month and
+# category and per year and recurring vendor, counts per country and the set
+# of vendors. summarize_transactions computes them from transactions and
+# merge_summaries adds summaries up, so the rollup item stored with every
+# month can stand in for that month's transactions. Totals are integer cents
+# in [label, ..., cents] lists, since the report's key order and the home
+# country tie-break depend on the order of first appearance. The amount
+# statistics per category and vendor are described under "Amount statistics".
+def summarize_transactions(transactions):
+    batch = TransactionBatch(transactions)
+    rows = batch.rows()
+    buckets = sketch_buckets(batch.amount_cents)
+    months = batch.monthly_cents(rows)
+    years = dict.fromkeys(str(year) for year in batch.year[batch.recurring].tolist())
+    codes, first_seen, counts = np.unique(batch.country_codes, return_index=True, return_counts=True)
+    order = np.argsort(first_seen)
+    return {
+        "count": batch.size,
+        "total_cents": int(batch.amount_cents.sum()),
+        "square_cents": sum(cents * cents for cents in batch.amount_cents.tolist()),
+        "months": [[month, cents] for month, cents in months.items()],
+        "categories": [
+            [month, category, cents]
+            for month in months
+            for category, cents in batch.category_cents(batch.rows_in_month(rows, month)).items()
+        ],
+        "recurring": [
+            [year, vendor, cents]
+            for year in years
+            for vendor, cents in batch.recurring_cents(rows, year).items()
+        ],
+        "countries": [[batch.countries[codes[i]], int(counts[i])] for i in order],
+        "vendors": list(batch.vendors),
+        "sketch": sketch_counts(buckets),
+        "category_stats": amount_stats(batch, batch.category_codes, batch.categories, buckets),
+        "vendor_stats": amount_stats(batch, batch.vendor_codes, batch.vendors, buckets),
+        **({"charges": vendor_charges(batch, rows)} if RECURRING_SOURCE == "detect" else {}),
+    }
 
-    previous_year_month = f"{previous_year}{previous_month:02d}"
+def merge_summaries(summaries):
+    # DynamoDB hands the numbers back as Decimal.
+    count = total_cents = square_cents = 0
+    months, categories, recurring, countries, vendors = {}, {}, {}, {}, {}
+    sketch, category_stats, vendor_stats, charges = {}, {}, {}, {}
+    for summary in summaries:
+        count += int(summary["count"])
+        total_cents += int(summary["total_cents"])
+        square_cents += int(summary["square_cents"])
+        for month, cents in summary["months"]:
+            months[month] = months.get(month, 0) + int(cents)
+        for month, category, cents in summary["categories"]:
+            categories[(month, category)] = categories.get((month, category), 0) + int(cents)
+        for year, vendor, cents in summary["recurring"]:
+            recurring[(year, vendor)] = recurring.get((year, vendor), 0) + int(cents)
+        for country, country_count in summary["countries"]:
+            countries[country] = countries.get(country, 0) + int(country_count)
+        vendors.update(dict.fromkeys(summary["vendors"]))
+        for vendor, charge_count, days, amounts in summary.get("charges", []):
+            entry = charges.setdefault(vendor, [0, [], []])
+            entry[0] += int(charge_count)
+            entry[1].extend(int(day) for day in days)
+            entry[2].extend(int(cents) for cents in amounts)
+        # Rollups written before the statistics existed have none; backfill_rollups rewrites them.
+        add_sketch(sketch, summary.get("sketch", []))
+        merge_amount_stats(category_stats, summary.get("category_stats", []))
+        merge_amount_stats(vendor_stats, summary.get("vendor_stats", []))
+    return {
+        "count": count,
+        "total_cents": total_cents,
+        "square_cents": square_cents,
+        "months": [[month, cents] for month, cents in months.items()],
+        "categories": [[month, category, cents] for (month, category), cents in categories.items()],
+        "recurring": [[year, vendor, cents] for (year, vendor), cents in recurring.items()],
+        "countries": [[country, country_count] for country, country_count in countries.items()],
+        "vendors": list(vendors),
+        "sketch": sketch_counts_from(sketch),
+        "category_stats": [[label, *moments, sketch_counts_from(counts)] for label, (*moments, counts) in category_stats.items()],
+        "vendor_stats": [[label, *moments, sketch_counts_from(counts)] for label, (*moments, counts) in vendor_stats.items()],
+        **({"charges": [[vendor, *entry] for vendor, entry in charges.items()]} if charges else {}),
+    }
 
-    # Filter transactions 
-    previous_month_transactions = [
-        transaction for transaction in all_transactions
-        if transaction["date"][:7].replace("-", "") == previous_year_month
+def summary_average(summary):
+    # Merged rollups only keep the exact total in cents, so where the float sum
+    # query_history uses lands on the other side of a half cent the two
+    # sources differ by a cent.
+    if "average" in summary:
+        return summary["average"]
+    if not summary["count"]:
+        return 0
+    return round(summary["total_cents"] / 100 / summary["count"], 2)
+
+def summary_home_country(summary):
+    #  country with the highest count = home countery (ties go to the one seen first)
+    if not summary["countries"]:
+        return None
+    return country_name(max(summary["countries"], key=lambda entry: entry[1])[0])
+
+def summary_month_categories(summary, year_month):
+    return {category: cents for month, category, cents in summary["categories"] if month == year_month}
+
+def summary_recurring(summary, year):
+    return {vendor: cents for recurring_year, vendor, cents in summary["recurring"] if recurring_year == year}
+
+#### Amount statistics ####
+# For the user as a whole, each category and each vendor the summaries keep
+# the count, sum and sum of squares of the amounts in cents, which give the
+# mean and variance exactly and add up across months, and a quantile sketch:
+# amounts counted per logarithmic bucket, bucket i holding (GAMMA**(i-1),
+# GAMMA**i] cents and -1 anything below a cent. Estimating a quantile as the
+# middle of its bucket is within SKETCH_ACCURACY of the true amount. Only the
+# buckets that occur are stored, out of about 400 up to $100,000.
+# Stats are [label, count, total_cents, square_cents, [[bucket, count], ...]].
+SKETCH_ACCURACY = 0.02
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+
+def sketch_buckets(amount_cents):
+    positive = np.maximum(amount_cents, 1)
+    buckets = np.ceil(np.log(positive) / math.log(SKETCH_GAMMA)).astype(np.int64)
+    return np.where(amount_cents > 0, buckets, -1)
+
+def sketch_counts(buckets):
+    values, counts = np.unique(buckets, return_counts=True)
+    return [[int(bucket), int(count)] for bucket, count in zip(values, counts)]
+
+def sketch_counts_from(counts):
+    return [[bucket, counts[bucket]] for bucket in sorted(counts)]
+
+def add_sketch(counts, sketch):
+    for bucket, count in sketch:
+        counts[int(bucket)] = counts.get(int(bucket), 0) + int(count)
+
+def sketch_quantile(sketch, q):
+    # Amount in cents at quantile q (0..1) of a [[bucket, count], ...] sketch.
+    rank = q * (sum(int(count) for _, count in sketch) - 1)
+    seen = 0
+    for bucket, count in sketch:
+        seen += int(count)
+        if seen > rank:
+            return 0.0 if bucket < 0 else 2 * SKETCH_GAMMA ** int(bucket) / (SKETCH_GAMMA + 1)
+    return None
+
+def amount_stats(batch, codes, labels, buckets):
+    if not batch.size:
+        return []
+    counts = np.bincount(codes, minlength=len(labels))
+    totals = np.bincount(codes, weights=batch.amount_cents, minlength=len(labels))
+    # Sums of squares in Python ints, since float64 is only exact to 2**53.
+    squares = [0] * len(labels)
+    for code, cents in zip(codes.tolist(), batch.amount_cents.tolist()):
+        squares[code] += cents * cents
+    pairs, pair_counts = np.unique(np.stack([codes, buckets]), axis=1, return_counts=True)
+    sketches = [[] for _ in labels]
+    for (code, bucket), count in zip(pairs.T.tolist(), pair_counts.tolist()):
+        sketches[code].append([bucket, count])
+    return [
+        [label, int(counts[code]), int(totals[code]), squares[code], sketches[code]]
+        for code, label in enumerate(labels)
     ]
 
-    return spending_by_category(previous_month_transactions)
-
-def generate_pie_chart(spending_by_category_current, spending_by_category_previous, user_id, year_month):
-
+def merge_amount_stats(merged, stats):
+    for label, count, total_cents, square_cents, sketch in stats:
+        entry = merged.setdefault(label, [0, 0, 0, {}])
+        entry[0] += int(count)
+        entry[1] += int(total_cents)
+        entry[2] += int(square_cents)
+        add_sketch(entry[3], sketch)
+
+_country_names = None
+
+def country_names():
+    # alpha-2 code -> country name, built once per container.
+    global _country_names
+    if _country_names is None:
+        import pycountry
+        _country_names = {country.alpha_2: sys.intern(country.name) for country in pycountry.countries}
+    return _country_names
+
+def country_name(country_code):
+    return country_names().get(country_code, country_code)
+
+RISK_ZSCORE_THRESHOLD = float(os.environ.get("RISK_ZSCORE_THRESHOLD", "3"))
+RISK_VELOCITY_LIMIT = int(os.environ.get("RISK_VELOCITY_LIMIT", "5"))
+RISK_MODERATE_SCORE = int(os.environ.get("RISK_MODERATE_SCORE", "2"))
+RISK_HIGH_SCORE = int(os.environ.get("RISK_HIGH_SCORE", "3"))
+
+# Each rule returns a boolean mask over the current rows.
+def foreign_country_rule(batch, current_rows, history, home_country, historical_average):
+    names = np.array([country_name(code) for code in batch.countries] or [None], dtype=object)
+    return names[batch.country_codes[current_rows]] != home_country
+
+def above_average_rule(batch, current_rows, history, home_country, historical_average):
+    return batch.amount_cents[current_rows] / 100 > historical_average
+
+RISK_MIN_SAMPLES = int(os.environ.get("RISK_MIN_SAMPLES", "10"))
+RISK_PERCENTILE = float(os.environ.get("RISK_PERCENTILE", "99"))
+
+def baseline_arrays(labels, stats):
+    # Mean, standard deviation and RISK_PERCENTILE amount in cents of every
+    # label with at least RISK_MIN_SAMPLES amounts in its stats; inf otherwise,
+    # so nothing is flagged against a baseline too thin to trust.
+    by_label = {entry[0]: entry for entry in stats}
+    means = np.zeros(len(labels))
+    deviations = np.full(len(labels), np.inf)
+    percentiles = np.full(len(labels), np.inf)
+    for code, label in enumerate(labels):
+        entry = by_label.get(label)
+        if entry is None or int(entry[1]) < RISK_MIN_SAMPLES:
+            continue
+        count, total, square = int(entry[1]), int(entry[2]), int(entry[3])
+        spread = count * square - total * total
+        means[code] = total / count
+        if spread:
+            deviations[code] = math.sqrt(spread) / count
+        percentile = sketch_quantile(entry[4], RISK_PERCENTILE / 100)
+        if percentile is not None:
+            percentiles[code] = percentile
+    return means, deviations, percentiles
+
+def scoped_zscore(batch, current_rows, codes, labels, stats):
+    means, deviations, _ = baseline_arrays(labels, stats)
+    row_codes = codes[current_rows]
+    return (batch.amount_cents[current_rows] - means[row_codes]) / deviations[row_codes] >= RISK_ZSCORE_THRESHOLD
+
+def category_zscore_rule(batch, current_rows, history, home_country, historical_average):
+    return scoped_zscore(batch, current_rows, batch.category_codes, batch.categories, history["category_stats"])
+
+def vendor_zscore_rule(batch, current_rows, history, home_country, historical_average):
+    return scoped_zscore(batch, current_rows, batch.vendor_codes, batch.vendors, history["vendor_stats"])
+
+def category_percentile_rule(batch, current_rows, history, home_country, historical_average):
+    _, _, percentiles = baseline_arrays(batch.categories, history["category_stats"])
+    return batch.amount_cents[current_rows] > percentiles[batch.category_codes[current_rows]]
+
+def amount_zscore_rule(batch, current_rows, history, home_country, historical_average):
+    count, total = history["count"], history["total_cents"]
+    # Population variance times count**2, exact in integers.
+    spread = count * history["square_cents"] - total * total
+    if count < 2 or not spread:
+        return np.zeros(len(current_rows), dtype=bool)
+    return (batch.amount_cents[current_rows] - total / count) / (math.sqrt(spread) / count) >= RISK_ZSCORE_THRESHOLD
+
+def new_vendor_rule(batch, current_rows, history, home_country, historical_average):
+    if not history["count"]:
+        return np.zeros(len(current_rows), dtype=bool)
+    vendors = set(history["vendors"])
+    known = np.array([vendor in vendors for vendor in batch.vendors] or [False], dtype=bool)
+    return ~known[batch.vendor_codes[current_rows]]
+
+def velocity_rule(batch, current_rows, history, home_country, historical_average):
+    if not len(current_rows):
+        return np.zeros(0, dtype=bool)
+    days = np.array([batch.transactions[row]["date"] for row in current_rows])
+    _, day_codes, counts = np.unique(days, return_inverse=True, return_counts=True)
+    return counts[day_codes.ravel()] > RISK_VELOCITY_LIMIT
+
+RISK_RULES = {
+    "foreign_country": (foreign_country_rule, 2),
+    "above_average": (above_average_rule, 1),
+    "amount_zscore": (amount_zscore_rule, 2),
+    "category_zscore": (category_zscore_rule, 2),
+    "vendor_zscore": (vendor_zscore_rule, 2),
+    "category_percentile": (category_percentile_rule, 1),
+    "new_vendor": (new_vendor_rule, 1),
+    "velocity": (velocity_rule, 1),
+}
+
+def parse_risk_rules(spec):
+    # "foreign_country,amount_zscore:3" -> [(name, rule, weight), ...]
+    rules = []
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, weight = entry.partition(":")
+        rule, default_weight = RISK_RULES[name]
+        rules.append((name, rule, int(weight) if weight else default_weight))
+    return rules
+
+# The defaults reproduce the original logic: a foreign transaction is
+# flagged, and it is high risk when it is also above the historical average.
+ACTIVE_RISK_RULES = parse_risk_rules(os.environ.get("RISK_RULES", "foreign_country,above_average"))
+
+def score_risk(batch, current_rows, history, home_country, historical_average, rules=ACTIVE_RISK_RULES):
+    scores = np.zeros(len(current_rows), dtype=np.int64)
+    triggered = []
+    for name, rule, weight in rules:
+        mask = rule(batch, current_rows, history, home_country, historical_average)
+        scores += weight * mask
+        triggered.append((name, mask))
 
-    os.environ["MPLCONFIGDIR"] = "/tmp"
-
-    labels_current = list(spending_by_category_current.keys())
-    sizes_current = list(spending_by_category_current.values())
-
-    labels_previous = list(spending_by_category_previous.keys())
-    sizes_previous = list(spending_by_category_previous.values())
-
-    colors_current = cm.get_cmap("tab20c")(range(len(sizes_current)))
-    colors_previous = cm.get_cmap("tab20c")(range(len(sizes_previous)))
+    flagged_transactions = []
+    for position in np.flatnonzero(scores >= RISK_MODERATE_SCORE):
+        item = batch.transactions[current_rows[position]]
+        flagged_transactions.append({
+            "transaction_id": item["id"],
+            "amount": float(item["amount"]),
+            "avarage_amount": historical_average,
+            "location": country_name(item["location"][:2]),
+            "risk_level": "High Risk" if scores[position] >= RISK_HIGH_SCORE else "Moderate Risk",
+            "home_counter": home_country,
+            "categoty": item["category"],
+            'vendor': item["vendor"],
+            'date': item["date"],
+            "rules": [name for name, mask in triggered if mask[position]],
+        })
+    return flagged_transactions
 
-    fig, axes = plt.subplots(1, 2, figsize=(16, 8))  
+# matplotlib's "tab20c" colormap; pies index into it like cmap(range(n)) does.
+TAB20C = (
+    "#3182bd", "#6baed6", "#9ecae1", "#c6dbef", "#e6550d", "#fd8d3c", "#fdae6b", "#fdd0a2",
+    "#31a354", "#74c476", "#a1d99b", "#c7e9c0", "#756bb1", "#9e9ac8", "#bcbddc", "#dadaeb",
+    "#636363", "#969696", "#bdbdbd", "#d9d9d9",
+)
+
+# "raster" renders PNGs with matplotlib; "vector" draws the charts straight
+# into the PDF with FPDF primitives and never imports matplotlib.
+CHART_MODE = os.environ.get("CHART_MODE", "raster")
+
+_chart_templates = {}
+
+def chart_template(name, figsize, columns=1, **layout):
+    # Figures and their canvases are created once per process instead of going
+    # through pyplot and tight_layout. The axes are rebuilt for every user, as
+    # Axes.clear() leaves some state behind (e.g. what a blank pie panel or
+    # pie() itself sets), which made a chart depend on the users drawn before.
+    figure = _chart_templates.get(name)
+    if figure is None:
+        Figure, FigureCanvasAgg = matplotlib_figure()
+        figure = _chart_templates[name] = Figure(figsize=figsize)
+        FigureCanvasAgg(figure)
+    figure.clear()
+    axes = list(figure.subplots(1, columns, squeeze=False)[0])
+    figure.subplots_adjust(**layout)
+    return figure, axes
+
+def palette(count):
+    return [TAB20C[min(index, len(TAB20C) - 1)] for index in range(count)]
 
-    axes[0].pie(
-        sizes_current,
-        labels=labels_current,
-        autopct='%1.1f%%',
-        startangle=140,
-        colors=colors_current,
-        textprops={'fontsize': 10},
-        wedgeprops={'edgecolor': 'white'},
-        pctdistance=0.85,
-        labeldistance=1.1
-    )
-    axes[0].set_title(f'Current Month: {year_month}', fontsize=14, pad=20)
-
-    axes[1].pie(
-        sizes_previous,
-        labels=labels_previous,
-        autopct='%1.1f%%',
-        startangle=140,
-        colors=colors_previous,
-        textprops={'fontsize': 10},
-        wedgeprops={'edgecolor': 'white'},
-        pctdistance=0.85,
-        labeldistance=1.1
-    )
-    previous_month = str(int(year_month) - 1)  # Calculate the previous month
-    axes[1].set_title(f'Previous Month: {previous_month}', fontsize=14, pad=20)
+def generate_pie_chart(spending_by_category_current, spending_by_category_previous, user_id, year_month):
+    previous_month = shift_year_month(year_month, -1)
+    panels = [
+        (f'Current Month: {year_month}', list(spending_by_category_current.keys()), list(spending_by_category_current.values())),
+        (f'Previous Month: {previous_month}', list(spending_by_category_previous.keys()), list(spending_by_category_previous.values())),
+    ]
+    if CHART_MODE == "vector":
+        return {"kind": "pie", "panels": panels}
+
+    figure, axes = chart_template("pie", (16, 8), columns=2, left=0.06, right=0.94, top=0.88, bottom=0.06, wspace=0.35)
+    for ax, (title, labels, sizes) in zip(axes, panels):
+        ax.set_title(title, fontsize=14, pad=20)
+        if not sum(sizes):
+            # Nothing was spent (e.g. no previous month yet); leave the panel blank.
+            ax.set_axis_off()
+            continue
+        ax.pie(
+            sizes,
+            labels=labels,
+            autopct='%1.1f%%',
+            startangle=140,
+            colors=palette(len(sizes)),
+            textprops={'fontsize': 10},
+            wedgeprops={'edgecolor': 'white'},
+            pctdistance=0.85,
+            labeldistance=1.1
+        )
 
-    plt.tight_layout()
-    pie_chart_path = f"/tmp/user_{user_id}_spending_by_category_{year_month}_comparison.png"
-    plt.savefig(pie_chart_path, bbox_inches='tight')
-    plt.close()
-    return pie_chart_path
+    return render_figure(figure)
 
-def identify_high_value_transactions(current_transactions, historical_average):
+def high_value_records(batch, rows):
     high_value_transactions = []
-    for item in current_transactions:
-        if float(item["amount"]) > historical_average:
-            high_value_transactions.append({
-                "transaction_id": item["id"],
-                "amount": round(float(item["amount"]), 2), 
-                "vendor": item["vendor"],
-                "category": item["category"],
-                "date": item["date"],
-                "location": item["location"]
-            })
+    for row in rows:
+        item = batch.transactions[row]
+        high_value_transactions.append({
+            "transaction_id": item["id"],
+            "amount": int(batch.amount_cents[row]) / 100,
+            "vendor": item["vendor"],
+            "category": item["category"],
+            "date": item["date"],
+            "location": item["location"]
+        })
     return high_value_transactions
 
-def analyze_recurring_transactions(current_transactions, historical_data, year):
-    recurring_transactions_summary = {}
-
-    all_transactions = current_transactions + historical_data
-
-    for transaction in all_transactions:
-        transaction_year = transaction["date"][:4] 
-        if transaction_year == year and transaction["recurring"]:
-            vendor = transaction["vendor"]
-            if vendor not in recurring_transactions_summary:
-                recurring_transactions_summary[vendor] = 0
-            recurring_transactions_summary[vendor] += round(float(transaction["amount"]), 2)
-
-    return recurring_transactions_summary
-
-def calculate_monthly_spending_trend(historical_data, current_transactions):
-    all_transactions = current_transactions + historical_data
-
-    monthly_spending = {}
-    for transaction in all_transactions:
-        year_month = transaction["date"][:7].replace("-", "") 
-        if year_month not in monthly_spending:
-            monthly_spending[year_month] = 0
-        monthly_spending[year_month] += round(float(transaction["amount"]), 2)
+#### Recurring charge detection ####
+# RECURRING_SOURCE=flag trusts the statement's recurring column. With
+# "detect", charges are grouped by normalized vendor, and a vendor is
+# recurring when the gaps between its charges match one of CADENCES and its
+# amounts are stable; its forecast adds the charges that cadence still has
+# to come this year instead of extrapolating the year-to-date linearly.
+# In that mode only, summaries keep the dates and amounts of every vendor as
+# "charges", [vendor, count, [day, ...], [cents, ...]], except for vendors
+# charged more than RECURRING_MAX_MONTHLY_CHARGES times in a month, which are
+# never subscriptions and only keep their count. Months summarized before
+# switching have none; backfill_rollups rewrites them. A statement's reports
+# are detected RECURRING_BLOCK_REPORTS at a time.
+RECURRING_SOURCE = os.environ.get("RECURRING_SOURCE", "flag")
+RECURRING_MIN_CHARGES = int(os.environ.get("RECURRING_MIN_CHARGES", "3"))
+RECURRING_MAX_MONTHLY_CHARGES = 5
+RECURRING_INTERVAL_TOLERANCE = float(os.environ.get("RECURRING_INTERVAL_TOLERANCE", "0.15"))
+RECURRING_AMOUNT_TOLERANCE = float(os.environ.get("RECURRING_AMOUNT_TOLERANCE", "0.25"))
+RECURRING_BLOCK_REPORTS = int(os.environ.get("RECURRING_BLOCK_REPORTS", "32"))
+RECURRING_REGULAR_SHARE = 0.75  # of the gaps, so a late or skipped charge is tolerated
+CADENCES = {"weekly": 7, "biweekly": 14, "monthly": 30.44, "quarterly": 91.31, "yearly": 365.25}
+VENDOR_NOISE = frozenset({
+    "com", "www", "net", "org", "bill", "billing", "payment", "pmt", "autopay",
+    "inc", "llc", "ltd", "co", "corp", "subscription", "recurring",
+})
+
+_vendor_keys = {}
+
+def normalize_vendor(vendor):
+    # "Apple.com/Bill", "APPLE.COM/BILL 866-712-7753" -> "apple"
+    key = _vendor_keys.get(vendor)
+    if key is None:
+        words = re.findall(r"[a-z]+", vendor.lower())
+        key = " ".join(word for word in words if word not in VENDOR_NOISE) or vendor.strip().lower()
+        _vendor_keys[vendor] = key
+    return key
+
+def vendor_charges(batch, rows):
+    if not len(rows):
+        return []
+    days = batch.days(rows)
+    sort = np.lexsort((days, batch.vendor_codes[rows]))
+    order, days = rows[sort], days[sort]
+    bounds = np.flatnonzero(np.diff(batch.vendor_codes[order])) + 1
+    # Most charges any vendor has in one month.
+    pairs, pair_counts = np.unique(np.stack([batch.vendor_codes[rows], batch.year_month[rows]]), axis=1, return_counts=True)
+    monthly_charges = np.zeros(len(batch.vendors), dtype=np.int64)
+    np.maximum.at(monthly_charges, pairs[0], pair_counts)
+    charges = []
+    for group, group_days in zip(np.split(order, bounds), np.split(days, bounds)):
+        dated = monthly_charges[batch.vendor_codes[group[0]]] <= RECURRING_MAX_MONTHLY_CHARGES
+        charges.append([
+            batch.vendors[batch.vendor_codes[group[0]]],
+            len(group),
+            group_days.tolist() if dated else [],
+            batch.amount_cents[group].tolist() if dated else [],
+        ])
+    return charges
+
+def detect_recurring(group_codes, days, cents):
+    # One sort over the charges of any number of groups (vendors of a user,
+    # or users and vendors). Returns {group code: (cadence, period in days,
+    # last day, last cents)} for the groups charging on a regular cadence.
+    if not len(group_codes):
+        return {}
+    order = np.lexsort((days, group_codes))
+    codes, days, cents = group_codes[order], days[order], cents[order].astype(np.float64)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    counts = np.diff(np.r_[starts, len(codes)])
+    groups = len(starts)
+    within = codes[1:] == codes[:-1]
+    gaps = np.diff(days)[within].astype(np.float64)
+    gap_groups = np.repeat(np.arange(groups), counts)[1:][within]
+    gap_counts = counts - 1
+
+    # Median gap of each group: the gaps sorted within groups, then the middle one.
+    eligible = counts >= max(RECURRING_MIN_CHARGES, 2)
+    sorted_gaps = gaps[np.lexsort((gaps, gap_groups))]
+    gap_starts = np.cumsum(gap_counts) - gap_counts
+    median = np.zeros(groups)
+    median[eligible] = sorted_gaps[gap_starts[eligible] + (gap_counts[eligible] - 1) // 2]
+    periods = np.array(list(CADENCES.values()))
+    nearest = np.argmin(np.abs(median[:, None] - periods), axis=1)
+    period = periods[nearest]
+    tolerance = RECURRING_INTERVAL_TOLERANCE * period
+    on_cadence = np.abs(median - period) <= tolerance
+    regular = np.abs(gaps - period[gap_groups]) <= tolerance[gap_groups]
+    regular_share = np.bincount(gap_groups, weights=regular, minlength=groups) / np.maximum(gap_counts, 1)
+
+    mean = np.add.reduceat(cents, starts) / counts
+    variance = np.maximum(np.add.reduceat(cents * cents, starts) / counts - mean * mean, 0)
+    stable = np.sqrt(variance) <= RECURRING_AMOUNT_TOLERANCE * np.abs(mean)
+
+    names = list(CADENCES)
+    ends = starts + counts - 1
+    return {
+        int(codes[starts[group]]): (names[nearest[group]], float(period[group]), int(days[ends[group]]), int(cents[ends[group]]))
+        for group in np.flatnonzero(eligible & on_cadence & (regular_share >= RECURRING_REGULAR_SHARE) & stable)
+    }
 
+def recurring_charges(batch, current_rows, history):
+    # The dated charges of history and the current month as parallel lists,
+    # keyed by normalized vendor, with the keys of vendors too frequent to be
+    # dated and the vendor as last written for each key.
+    keys, days, cents, undated, latest = [], [], [], set(), {}
+    for vendor, count, vendor_days, vendor_cents in history.get("charges", []) + vendor_charges(batch, current_rows):
+        key = normalize_vendor(vendor)
+        if int(count) > len(vendor_days):
+            undated.add(key)
+        keys.extend([key] * len(vendor_days))
+        days.extend(vendor_days)
+        cents.extend(vendor_cents)
+        if vendor_days and max(vendor_days) >= latest.get(key, (-math.inf, None))[0]:
+            latest[key] = (max(vendor_days), vendor)
+    return keys, days, cents, undated, latest
+
+def detected_recurring(reports):
+    # Year-to-date cents and year-end forecasts of the detected recurring
+    # charges of each (batch, current rows, history, year_month) in reports,
+    # keyed by the vendor as last written on a statement. The charges of all
+    # reports are grouped by (report, vendor) and go through one
+    # detect_recurring call.
+    charges = [recurring_charges(batch, current_rows, history) for batch, current_rows, history, _ in reports]
+    owners = np.repeat(np.arange(len(reports)), [len(keys) for keys, *_ in charges])
+    codes, labels = encode_column(list(zip(owners.tolist(), (key for keys, *_ in charges for key in keys))))
+    days = np.array([day for _, report_days, *_ in charges for day in report_days], dtype=np.int64)
+    cents = np.array([amount for _, _, report_cents, *_ in charges for amount in report_cents], dtype=np.int64)
+
+    years = [year_month[:4] for *_, year_month in reports]
+    year_start = np.array([np.datetime64(f"{year}-01-01") for year in years], dtype="datetime64[D]").astype(np.int64)
+    year_end = np.array([np.datetime64(f"{year}-12-31") for year in years], dtype="datetime64[D]").astype(np.int64)
+    month_end = np.array(
+        [np.datetime64(f"{year_month[:4]}-{year_month[4:]}") + 1 for *_, year_month in reports], dtype="datetime64[M]"
+    ).astype("datetime64[D]").astype(np.int64) - 1
+    window = (days >= year_start[owners]) & (days <= month_end[owners])
+    spent_by_code = np.zeros(len(labels), dtype=np.int64)
+    np.add.at(spent_by_code, codes[window], cents[window])
+
+    results = [({}, {}) for _ in reports]
+    for code, (cadence, period, last_day, last_cents) in sorted(detect_recurring(codes, days, cents).items()):
+        owner, key = labels[code]
+        _, _, _, undated, latest = charges[owner]
+        if key in undated:
+            continue
+        spent = int(spent_by_code[code])
+        # Lapsed once a charge is overdue by more than the tolerance.
+        active = last_day + period * (1 + RECURRING_INTERVAL_TOLERANCE) >= month_end[owner]
+        remaining = int((year_end[owner] - last_day) // period) if active else 0
+        if not spent and not remaining:
+            continue
+        vendor = latest[key][1]
+        year_to_date, forecasts = results[owner]
+        year_to_date[vendor] = spent
+        forecasts[vendor] = {
+            "cadence": cadence,
+            "next_date": str(np.datetime64(int(last_day + round(period)), "D")) if active else None,
+            "predicted": (spent + remaining * last_cents) / 100,
+        }
+    return results
+
+def spending_trend(monthly_spending):
     # Sort spending by month 
     sorted_months = sorted(monthly_spending.keys(), reverse=True)
 
@@ -281,38 +1093,32 @@ def calculate_monthly_spending_trend(historical_data, current_transactions):
     }
 
 def generate_bar_line_chart(monthly_spending, user_id, year_month):
-
-    os.environ["MPLCONFIGDIR"] = "/tmp"  
-
     sorted_months = sorted(monthly_spending.keys())
     spending_values = [monthly_spending[month] for month in sorted_months]
+    if CHART_MODE == "vector":
+        return {"kind": "trend", "user_id": user_id, "months": sorted_months, "values": spending_values}
 
-    plt.figure(figsize=(8, 5))
-    
-    plt.bar(sorted_months, spending_values, color='lightblue', alpha=0.7, label="Monthly Spending")
-    
-    plt.plot(sorted_months, spending_values, marker='o', color='b', label="Spending Trend")
+    figure, (ax,) = chart_template("trend", (8, 5), left=0.11, right=0.97, top=0.92, bottom=0.2)
+    ax.bar(sorted_months, spending_values, color='lightblue', alpha=0.7, label="Monthly Spending")
+    ax.plot(sorted_months, spending_values, marker='o', color='b', label="Spending Trend")
 
-    plt.xlabel("YearMonth")
-    plt.ylabel("Spending ($)")
-    plt.title(f"Monthly Spending Trend for User {user_id}")
-    plt.xticks(rotation=45)
-    plt.grid(axis='y', linestyle='--', alpha=0.7)
-    plt.legend()
+    ax.set_xlabel("YearMonth")
+    ax.set_ylabel("Spending ($)")
+    ax.set_title(f"Monthly Spending Trend for User {user_id}")
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.grid(axis='y', linestyle='--', alpha=0.7)
+    ax.legend()
 
-    trend_chart_path = f"/tmp/user_{user_id}_spending_trend_{year_month}.png"
-    plt.tight_layout()
-    plt.savefig(trend_chart_path)
-    plt.close()
-
-    return trend_chart_path
+    return render_figure(figure)
 
 def get_top_high_value_transactions(high_value_transaction, limit=3):
 
     sorted_transactions = sorted(high_value_transaction, key=lambda x: x['amount'], reverse=True)
     return sorted_transactions[:limit]
 
-def generate_pdf_report(user_id, year_month, pie_chart_path, trend_chart_path, recurring_graph_path, high_value_transaction, flagged_transactions):
+def generate_pdf_report(user_id, year_month, pie_chart, trend_chart, recurring_graph, high_value_transaction, flagged_transactions):
+    from fpdf import FPDF
+
     pdf = FPDF(orientation='P', unit='mm', format='A4')
     pdf.add_page()
 
@@ -323,17 +1129,17 @@ def generate_pdf_report(user_id, year_month, pie_chart_path, trend_chart_path, r
     # Spending Breakdown
     pdf.set_font('Arial', 'B', 14)
     pdf.cell(0, 10, "Spending Breakdown", ln=True)
-    pdf.image(pie_chart_path, x=40, w=130)
+    place_chart(pdf, pie_chart)
 
     # Monthly Spending Trend
     pdf.set_font('Arial', 'B', 14)
     pdf.cell(0, 10, "Monthly Spending Trend", ln=True)
-    pdf.image(trend_chart_path, x=40, w=130)
+    place_chart(pdf, trend_chart)
 
     # Recurring Transactions Analysis
     pdf.set_font('Arial', 'B', 14)
     pdf.cell(0, 10, "Recurring Transactions Analysis", ln=True)
-    pdf.image(recurring_graph_path, x=40, w=130)
+    place_chart(pdf, recurring_graph)
 
     pdf.set_font('Arial', 'B', 14)
     pdf.cell(0, 10, "High-Value Transactions", ln=True)
@@ -373,6 +1179,13 @@ def generate_pdf_report(user_id, year_month, pie_chart_path, trend_chart_path, r
             reasons.append(
                 f"the amount of ${transaction['amount']:.2f} exceeds your historical average spending of ${transaction['avarage_amount']:.2f}."
             )
+        rules = transaction.get("rules", [])
+        if "amount_zscore" in rules:
+            reasons.append("the amount is unusually large compared with your past transactions.")
+        if "new_vendor" in rules:
+            reasons.append(f"it is your first transaction with {transaction['vendor']}.")
+        if "velocity" in rules:
+            reasons.append(f"it was one of an unusually high number of transactions on {transaction['date']}.")
 
         if reasons:
             for reason in reasons:
@@ -382,10 +1195,9 @@ def generate_pdf_report(user_id, year_month, pie_chart_path, trend_chart_path, r
 
         pdf.cell(0, 5, "", ln=True)
 
-    pdf_path = f"/tmp/user_{user_id}_report_{year_month}.pdf"
-    pdf.output(pdf_path)
-    return pdf_path
-def generate_recurring_transactions_graph(recurring_data, user_id, year_month):
+    # fpdf builds the document as a latin-1 string.
+    return pdf.output(dest='S').encode("latin1")
+def generate_recurring_transactions_graph(recurring_data, user_id, year_month, forecasts=None):
     vendors = list(recurring_data.keys())
     current_amounts = [round(value, 2) for value in recurring_data.values()]
 
@@ -393,27 +1205,34 @@ def generate_recurring_transactions_graph(recurring_data, user_id, year_month):
     months_elapsed = current_month
     months_remaining = 12 - months_elapsed
 
-    predicted_amounts = [
-        round(amount + (amount / months_elapsed) * months_remaining, 2)
-        for amount in current_amounts
-    ]
+    if forecasts is None:
+        predicted_amounts = [
+            round(amount + (amount / months_elapsed) * months_remaining, 2)
+            for amount in current_amounts
+        ]
+    else:
+        predicted_amounts = [round(forecasts[vendor]["predicted"], 2) for vendor in vendors]
+    title = f'Recurring Transactions for User {user_id} ({year_month})'
+    if CHART_MODE == "vector":
+        return {"kind": "recurring", "title": title, "vendors": vendors,
+                "current": current_amounts, "predicted": predicted_amounts}
 
+    figure, (ax,) = chart_template("recurring", (10, 6), left=0.08, right=0.98, top=0.93, bottom=0.25)
     x = np.arange(len(vendors))  
     bar_width = 0.6
 
-    plt.figure(figsize=(10, 6))
-    bars1 = plt.bar(x, current_amounts, bar_width, color='teal', label='Current Spending')
-    bars2 = plt.bar(x, predicted_amounts, bar_width, alpha=0.4, color='teal', label='Predicted Total Spending')
+    bars1 = ax.bar(x, current_amounts, bar_width, color='teal', label='Current Spending')
+    ax.bar(x, predicted_amounts, bar_width, alpha=0.4, color='teal', label='Predicted Total Spending')
 
-    plt.xticks(x, vendors, rotation=45, ha='right', fontsize=10)
-    plt.xlabel('Recurring Transactions (Vendors)', fontsize=12)
-    plt.ylabel('Amount Spent ($)', fontsize=12)
-    plt.title(f'Recurring Transactions for User {user_id} ({year_month})', fontsize=14)
-    plt.grid(axis='y', linestyle='--', alpha=0.7)
-    plt.legend()
+    ax.set_xticks(x, vendors, rotation=45, ha='right', fontsize=10)
+    ax.set_xlabel('Recurring Transactions (Vendors)', fontsize=12)
+    ax.set_ylabel('Amount Spent ($)', fontsize=12)
+    ax.set_title(title, fontsize=14)
+    ax.grid(axis='y', linestyle='--', alpha=0.7)
+    ax.legend()
 
     for i, bar1 in enumerate(bars1):
-        plt.text(
+        ax.text(
             bar1.get_x() + bar1.get_width() / 2,
             bar1.get_height() + 5,
             f"${current_amounts[i]}",
@@ -423,133 +1242,1669 @@ def generate_recurring_transactions_graph(recurring_data, user_id, year_month):
             color='black',
         )
 
-    recurring_graph_path = f"/tmp/user_{user_id}_recurring_transactions_{year_month}.png"
-    plt.tight_layout()
-    plt.savefig(recurring_graph_path)
-    plt.close()
-    return recurring_graph_path
-
-def upload_to_s3(file_path, bucket_name, key):
+    return render_figure(figure)
+
+#### Vector charts (CHART_MODE=vector) ####
+# fpdf has no path primitives, so filled shapes are written as raw PDF path
+# operators. Boxes match the size the raster PNGs take up on the page.
+CHART_WIDTH = 130
+CHART_HEIGHTS = {"pie": 65, "trend": 81.25, "recurring": 78}
+
+def hex_to_rgb(color):
+    return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+
+def pdf_shape(pdf, points, fill=None, stroke=None, line_width=0.2, closed=True):
+    k, height = pdf.k, pdf.h
+    operators = ["q", f"{line_width * k:.2f} w"]
+    if fill:
+        operators.append("%.3f %.3f %.3f rg" % tuple(c / 255 for c in fill))
+    if stroke:
+        operators.append("%.3f %.3f %.3f RG" % tuple(c / 255 for c in stroke))
+    operators.append(f"{points[0][0] * k:.2f} {(height - points[0][1]) * k:.2f} m")
+    operators.extend(f"{x * k:.2f} {(height - y) * k:.2f} l" for x, y in points[1:])
+    if closed:
+        operators.append("b" if fill and stroke else "f" if fill else "s")
+    else:
+        operators.append("S")
+    operators.append("Q")
+    pdf._out(" ".join(operators))
+
+def pdf_rotated_text(pdf, x, y, text, angle):
+    radians = math.radians(angle)
+    cos, sin = math.cos(radians), math.sin(radians)
+    pdf._out(f"q {cos:.4f} {sin:.4f} {-sin:.4f} {cos:.4f} {x * pdf.k:.2f} {(pdf.h - y) * pdf.k:.2f} cm")
+    pdf.text(0, pdf.h, text)
+    pdf._out("Q")
+
+def pdf_centered_text(pdf, x, y, text):
+    pdf.text(x - pdf.get_string_width(text) / 2, y, text)
+
+def nice_ticks(max_value, count=5):
+    if max_value <= 0:
+        return [0, 1]
+    raw_step = max_value / count
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw_step)
+    return [step * i for i in range(int(math.ceil(max_value / step - 1e-9)) + 1)]
+
+def draw_vector_axes(pdf, x, y, width, height, max_value, title, x_label, y_label):
+    # Returns the plot area and a function mapping a value to a page y.
+    left, top = x + 16, y + 9
+    plot_width, plot_height = width - 19, height - 30
+    ticks = nice_ticks(max_value)
+
+    def to_y(value):
+        return top + plot_height - value / ticks[-1] * plot_height
+
+    pdf.set_text_color(0, 0, 0)
+    pdf.set_font('Arial', '', 9)
+    pdf_centered_text(pdf, x + width / 2, y + 5, title)
+    pdf.set_font('Arial', '', 6)
+    pdf.set_draw_color(210, 210, 210)
+    pdf.set_line_width(0.1)
+    for tick in ticks:
+        pdf.line(left, to_y(tick), left + plot_width, to_y(tick))
+        label = f"{tick:g}"
+        pdf.text(left - 1.5 - pdf.get_string_width(label), to_y(tick) + 1, label)
+    pdf.set_draw_color(0, 0, 0)
+    pdf.rect(left, top, plot_width, plot_height)
+    pdf.set_font('Arial', '', 7)
+    pdf_centered_text(pdf, left + plot_width / 2, y + height - 3, x_label)
+    pdf_rotated_text(pdf, x + 3, top + plot_height / 2 + pdf.get_string_width(y_label) / 2, y_label, 90)
+    return left, top, plot_width, plot_height, to_y
+
+def draw_vector_legend(pdf, x, y, entries):
+    pdf.set_font('Arial', '', 6)
+    for offset, (label, color) in enumerate(entries):
+        pdf.set_fill_color(*color)
+        pdf.rect(x, y + offset * 3.5, 4, 2, 'F')
+        pdf.text(x + 5, y + offset * 3.5 + 2, label)
+
+def draw_vector_x_labels(pdf, centers, bottom, labels):
+    pdf.set_font('Arial', '', 6)
+    for center, label in zip(centers, labels):
+        width = pdf.get_string_width(label)
+        pdf_rotated_text(pdf, center - width * 0.71, bottom + 2 + width * 0.71, label, 45)
+
+def draw_vector_pie(pdf, x, y, width, height, chart):
+    radius = 20
+    for panel, (title, labels, sizes) in enumerate(chart["panels"]):
+        center_x, center_y = x + width / 4 * (1 + 2 * panel), y + height / 2 + 4
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_font('Arial', '', 9)
+        pdf_centered_text(pdf, center_x, y + 5, title)
+        total = sum(sizes)
+        if not total:
+            continue
+        angle = 140.0
+        for size, label, color in zip(sizes, labels, palette(len(sizes))):
+            sweep = 360.0 * size / total
+            steps = max(2, int(sweep / 3))
+            arc = [math.radians(angle + sweep * step / steps) for step in range(steps + 1)]
+            points = [(center_x, center_y)] + [
+                (center_x + radius * math.cos(a), center_y - radius * math.sin(a)) for a in arc
+            ]
+            pdf_shape(pdf, points, fill=hex_to_rgb(color), stroke=(255, 255, 255), line_width=0.3)
+            middle = math.radians(angle + sweep / 2)
+            pdf.set_font('Arial', '', 5)
+            pdf_centered_text(pdf, center_x + 0.85 * radius * math.cos(middle),
+                              center_y - 0.85 * radius * math.sin(middle) + 0.8, f"{100 * size / total:.1f}%")
+            pdf.set_font('Arial', '', 6)
+            label_x = center_x + 1.1 * radius * math.cos(middle)
+            if math.cos(middle) < 0:
+                label_x -= pdf.get_string_width(label)
+            pdf.text(label_x, center_y - 1.1 * radius * math.sin(middle) + 1, label)
+            angle += sweep
+
+def draw_vector_trend(pdf, x, y, width, height, chart):
+    months, values = chart["months"], chart["values"]
+    left, top, plot_width, plot_height, to_y = draw_vector_axes(
+        pdf, x, y, width, height, max(values, default=0),
+        f"Monthly Spending Trend for User {chart['user_id']}", "YearMonth", "Spending ($)",
+    )
+    bar_color, line_color = (198, 228, 238), (0, 0, 255)
+    slot = plot_width / max(len(months), 1)
+    centers = [left + slot * (i + 0.5) for i in range(len(months))]
+    pdf.set_fill_color(*bar_color)
+    for center, value in zip(centers, values):
+        pdf.rect(center - slot * 0.4, to_y(value), slot * 0.8, top + plot_height - to_y(value), 'F')
+    if len(centers) > 1:
+        pdf_shape(pdf, [(c, to_y(v)) for c, v in zip(centers, values)], stroke=line_color, line_width=0.4, closed=False)
+    for center, value in zip(centers, values):
+        marker = [(center + 0.8 * math.cos(a), to_y(value) + 0.8 * math.sin(a))
+                  for a in np.linspace(0, 2 * math.pi, 12, endpoint=False)]
+        pdf_shape(pdf, marker, fill=line_color)
+    draw_vector_x_labels(pdf, centers, top + plot_height, months)
+    draw_vector_legend(pdf, left + 2, top + 2, [("Monthly Spending", bar_color), ("Spending Trend", line_color)])
+
+def draw_vector_recurring(pdf, x, y, width, height, chart):
+    vendors, current, predicted = chart["vendors"], chart["current"], chart["predicted"]
+    left, top, plot_width, plot_height, to_y = draw_vector_axes(
+        pdf, x, y, width, height, max(predicted + current, default=0) * 1.1,
+        chart["title"], "Recurring Transactions (Vendors)", "Amount Spent ($)",
+    )
+    current_color, predicted_color = (0, 128, 128), (153, 204, 204)
+    slot = plot_width / max(len(vendors), 1)
+    centers = [left + slot * (i + 0.5) for i in range(len(vendors))]
+    bottom = top + plot_height
+    for center, spent, forecast in zip(centers, current, predicted):
+        pdf.set_fill_color(*predicted_color)
+        pdf.rect(center - slot * 0.3, to_y(forecast), slot * 0.6, bottom - to_y(forecast), 'F')
+        pdf.set_fill_color(*current_color)
+        pdf.rect(center - slot * 0.3, to_y(spent), slot * 0.6, bottom - to_y(spent), 'F')
+        pdf.set_font('Arial', '', 5)
+        pdf_centered_text(pdf, center, to_y(spent) - 1, f"${spent}")
+    draw_vector_x_labels(pdf, centers, bottom, vendors)
+    draw_vector_legend(pdf, left + 2, top + 2, [("Current Spending", current_color), ("Predicted Total Spending", predicted_color)])
+
+VECTOR_CHARTS = {"pie": draw_vector_pie, "trend": draw_vector_trend, "recurring": draw_vector_recurring}
+
+def place_chart(pdf, chart):
+    if chart["kind"] == "raster":
+        # Register the pixels directly so fpdf does not go looking for a file.
+        name = f"chart_{len(pdf.images)}.png"
+        pdf.images[name] = {
+            "w": chart["width"],
+            "h": chart["height"],
+            "cs": "DeviceRGB",
+            "bpc": 8,
+            "f": "FlateDecode",
+            "dp": f"/Predictor 15 /Colors 3 /BitsPerComponent 8 /Columns {chart['width']}",
+            "data": chart["data"],
+            "i": len(pdf.images) + 1,
+        }
+        pdf.image(name, x=40, w=CHART_WIDTH)
+        return
+    height = CHART_HEIGHTS[chart["kind"]]
+    if pdf.y + height > pdf.page_break_trigger:
+        pdf.add_page()
+    top = pdf.y
+    VECTOR_CHARTS[chart["kind"]](pdf, 40, top, CHART_WIDTH, height, chart)
+    pdf.set_text_color(0, 0, 0)
+    pdf.set_draw_color(0, 0, 0)
+    pdf.set_line_width(0.2)
+    pdf.set_y(top + height)
+
+REPORTS_BUCKET = "cpsc436c-g9-customer-reports"
+UPLOAD_JSON_REPORT = os.environ.get("UPLOAD_JSON_REPORT", "false").lower() == "true"
+
+def report_s3_key(user_id, year_month, extension):
+    return f"reports/user_{user_id}_report_{year_month}.{extension}"
+
+def upload_to_s3(data, bucket_name, key, content_type="application/pdf", metadata=None):
+    extra_args = {"ContentType": content_type}
+    if metadata:
+        extra_args["Metadata"] = metadata
     try:
-        s3_client.upload_file(file_path, "cpsc436c-g9-customer-reports", key)
+        # upload_fileobj streams the buffer (multipart when large) without touching /tmp.
+        with stage("upload") as timer:
+            get_s3_client().upload_fileobj(io.BytesIO(data), bucket_name, key, ExtraArgs=extra_args)
+            timer.bytes = len(data)
 
-        print(f"Uploaded {file_path} to {bucket_name}/{key}")
+        print(f"Uploaded {len(data)} bytes to {bucket_name}/{key}")
+        return True
     except ClientError as e:
         print(f"Error uploading to S3: {e.response['Error']['Message']}")
-
-### used for uploading the new statements to DynamoDB
-def process_csv(csv_path):
-    grouped_items = {}
+        return False
+
+#### Columnar export ####
+# With EXPORT_BUCKET set, the analysis results of every published report are
+# also written as one table per result type, partitioned by the statement
+# month: {EXPORT_PREFIX}{table}/year_month=YYYYMM/{run id}.npz, one file per
+# invocation. Each file is a compressed NumPy archive with one array per
+# column: amounts as int64 cents (EXPORT_NULL where there is none), dates as
+# datetime64[D] and text dictionary-encoded, int32 codes (-1 for none) in
+# "column" and the distinct values in "column.labels". load_export decodes a file.
+EXPORT_BUCKET = os.environ.get("EXPORT_BUCKET", "")
+EXPORT_PREFIX = os.environ.get("EXPORT_PREFIX", "analysis/")
+EXPORT_NULL = np.iinfo(np.int64).min
+EXPORT_TABLES = {
+    "flagged": ("user_id", "transaction_id", "date", "amount_cents", "average_cents", "category", "vendor",
+                "location", "home_country", "risk_level", "rules"),
+    "spending": ("user_id", "category", "amount_cents"),
+    "high_value": ("user_id", "transaction_id", "date", "amount_cents", "vendor", "category", "location"),
+    "recurring": ("user_id", "vendor", "year_to_date_cents", "predicted_cents", "cadence", "next_date"),
+    "monthly": ("user_id", "month", "amount_cents", "trend"),
+}
+
+def to_cents(amount):
+    return EXPORT_NULL if amount is None else round(amount * 100)
+
+def report_rows(report):
+    # (table, row) for every result in a report, rows in EXPORT_TABLES order.
+    user_id = report["UserId"]
+    for item in report["FlaggedTransactions"]:
+        yield "flagged", (
+            user_id, item["transaction_id"], item["date"], to_cents(item["amount"]), to_cents(item["avarage_amount"]),
+            item["categoty"], item["vendor"], item["location"], item["home_counter"], item["risk_level"],
+            ",".join(item.get("rules", [])),
+        )
+    for category, amount in report["SpendingByCategory"].items():
+        yield "spending", (user_id, category, to_cents(amount))
+    for item in report["HighValueTransaction"]:
+        yield "high_value", (
+            user_id, item["transaction_id"], item["date"], to_cents(item["amount"]), item["vendor"], item["category"],
+            item["location"],
+        )
+    forecasts = report.get("RecurringTransactionsForecast", {})
+    for vendor, amount in report["RecurringTransactionsYearToDate"].items():
+        forecast = forecasts.get(vendor, {})
+        yield "recurring", (
+            user_id, vendor, to_cents(amount), to_cents(forecast.get("predicted")), forecast.get("cadence"),
+            forecast.get("next_date"),
+        )
+    trend = report["MonthlySpending_Trend"]
+    for month, amount in trend["MonthlySpending"].items():
+        yield "monthly", (user_id, month, to_cents(amount), trend["Trend"])
+
+def export_column(name, values):
+    if name.endswith("_cents"):
+        return {name: np.array(values, dtype=np.int64)}
+    if name.endswith("date"):
+        return {name: np.array([value or "NaT" for value in values], dtype="datetime64[D]")}
+    codes, labels = encode_column(values)
+    labels = list(labels)
+    if None in labels:
+        missing = labels.index(None)
+        codes = np.where(codes == missing, -1, codes - (codes > missing))
+        labels.pop(missing)
+    return {name: codes.astype(np.int32), f"{name}.labels": np.array(labels, dtype=str)}
+
+def load_export(fileobj):
+    # Column name -> array, with text columns decoded (None for missing values).
+    with np.load(fileobj) as archive:
+        columns = {}
+        for name in archive.files:
+            if name.endswith(".labels"):
+                continue
+            values = archive[name]
+            if f"{name}.labels" in archive.files:
+                labels = np.append(archive[f"{name}.labels"].astype(object), None)
+                values = labels[values]  # -1 picks the trailing None
+            columns[name] = values
+        return columns
+
+class ResultExporter:
+    # Collects the rows of the reports published during one invocation; shared
+    # by the threads processing its statements.
+    def __init__(self, run_id=None, bucket=EXPORT_BUCKET, prefix=EXPORT_PREFIX):
+        self.run_id = run_id or f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+        self.bucket = bucket
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.rows = {}  # (table, YearMonth) -> rows
+
+    def add(self, report):
+        with self.lock:
+            for table, row in report_rows(report):
+                self.rows.setdefault((table, report["YearMonth"]), []).append(row)
+
+    def flush(self):
+        # Uploads one file per table and month; returns whether all of them made it.
+        with self.lock:
+            rows, self.rows = self.rows, {}
+        uploaded = True
+        for (table, year_month), table_rows in sorted(rows.items()):
+            arrays = {}
+            for name, values in zip(EXPORT_TABLES[table], zip(*table_rows)):
+                arrays.update(export_column(name, list(values)))
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, **arrays)
+            key = f"{self.prefix}{table}/year_month={year_month}/{self.run_id}.npz"
+            uploaded = upload_to_s3(buffer.getvalue(), self.bucket, key, "application/octet-stream") and uploaded
+        return uploaded
+
+#### Report cache ####
+# A report is identified by a digest of everything that goes into it: the
+# month's transactions, the history it is compared against and the settings
+# that shape the output. The digest is stored as metadata on the uploaded PDF,
+# so redelivered events and unchanged re-uploads are skipped after a HEAD
+# request, or without one when this container published the report itself.
+REPORT_VERSION = "1"  # bump whenever the analysis or layout changes
+REPORT_CACHE_SIZE = int(os.environ.get("REPORT_CACHE_SIZE", "4096"))
+_report_cache = OrderedDict()
+_report_cache_lock = threading.Lock()
+
+def report_digest(user_id, year_month, current_transactions, history):
+    settings = [
+        REPORT_VERSION, CHART_MODE, UPLOAD_JSON_REPORT,
+        [(name, weight) for name, _, weight in ACTIVE_RISK_RULES],
+        RISK_MODERATE_SCORE, RISK_HIGH_SCORE, RISK_ZSCORE_THRESHOLD, RISK_VELOCITY_LIMIT,
+        RISK_MIN_SAMPLES, RISK_PERCENTILE, RECURRING_SOURCE, RECURRING_MIN_CHARGES,
+        RECURRING_INTERVAL_TOLERANCE, RECURRING_AMOUNT_TOLERANCE,
+        user_id, year_month,
+    ]
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (settings, current_transactions, history):
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def remember_report(key, digest):
+    with _report_cache_lock:
+        _report_cache[key] = digest
+        _report_cache.move_to_end(key)
+        while len(_report_cache) > REPORT_CACHE_SIZE:
+            _report_cache.popitem(last=False)
+
+def report_is_current(key, digest):
+    with _report_cache_lock:
+        if _report_cache.get(key) == digest:
+            _report_cache.move_to_end(key)
+            return True
     try:
-        with open(csv_path, mode="r", encoding="utf-8-sig") as file:
-            csv_reader = csv.DictReader(file)
-
-            # Group transactions by UserId and YearMonth
-            for row in csv_reader:
-                transaction = {
-                    "amount": Decimal(row["transactions.amount"]),
-                    "category": row["transactions.category"],
-                    "currency": row["transactions.currency"],
-                    "date": row["transactions.date"],
-                    "description": row["transactions.description"],
-                    "id": row["transactions.id"],
-                    "location": row["transactions.location"],
-                    "recurring": row["transactions.recurring"].lower() == "true",
-                    "type": row["transactions.type"],
-                    "vendor": row["transactions.vendor"],
-                }
-
-                key = (row["UserId"], row["YearMonth"])
-                if key not in grouped_items:
-                    grouped_items[key] = []
-                grouped_items[key].append(transaction)
-
-        # Prepare items for DynamoDB
-        dynamo_data = []
-        for (user_id, year_month), transactions in grouped_items.items():
-            dynamo_data.append({
-                "UserId": user_id,  # String directly
-                "YearMonth": year_month,  # String directly
-                "transactions": transactions  # List of dictionaries
-            })
+        response = get_s3_client().head_object(Bucket=REPORTS_BUCKET, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+            print(f"Error checking report cache: {e.response['Error']['Message']}")
+        return False
+    if response.get("Metadata", {}).get("report-digest") != digest:
+        return False
+    remember_report(key, digest)
+    return True
+
+#### Compact storage ####
+# Plain items keep each month's transactions as a list of maps, repeating
+# every attribute name in every element. Compact items (STORAGE_FORMAT=compact)
+# store the month column by column instead: text columns dictionary-encoded,
+# amounts as integer cents where that is exact, the whole document
+# zlib-compressed into one binary "payload" attribute. A payload too large for
+# one item continues in overflow items keyed "<YearMonth>#001", "#002", ...;
+# the head item records how many chunks it has, so leftovers from an earlier,
+# larger write are ignored. Both formats are read transparently.
+STORAGE_FORMAT = os.environ.get("STORAGE_FORMAT", "plain")
+COMPACT_FORMAT = "compact-v1"
+COMPACT_CHUNK_BYTES = int(os.environ.get("COMPACT_CHUNK_BYTES", str(350 * 1024)))  # items are capped at 400 KB
+CHUNK_SEPARATOR = "#"
+_MISSING = object()
+
+def pack_column(values):
+    column = {}
+    missing = [row for row, value in enumerate(values) if value is _MISSING]
+    if missing:
+        column["missing"] = missing
+        values = [value for value in values if value is not _MISSING]
+    if values and all(isinstance(value, Decimal) for value in values):
+        if all(value.as_tuple().exponent == -2 for value in values):
+            column["cents"] = [int(value.scaleb(2)) for value in values]
+        else:
+            column["decimals"] = [str(value) for value in values]
+        return column
+    uniques = {}
+    try:
+        # Keyed by type too, since True, 1 and Decimal(1) hash alike.
+        index = [uniques.setdefault((type(value), value), len(uniques)) for value in values]
+    except TypeError:  # nested lists or maps
+        column["values"] = values
+        return column
+    if len(uniques) < len(values):
+        column["dictionary"] = [value for _, value in uniques]
+        column["index"] = index
+    else:
+        column["values"] = values
+    return column
+
+def unpack_column(column):
+    if "cents" in column:
+        return [Decimal(cents).scaleb(-2) for cents in column["cents"]]
+    if "decimals" in column:
+        return [Decimal(value) for value in column["decimals"]]
+    if "dictionary" in column:
+        dictionary = column["dictionary"]
+        return [dictionary[i] for i in column["index"]]
+    return column["values"]
+
+def encode_decimal(value):
+    if isinstance(value, Decimal):
+        return {"$decimal": str(value)}
+    raise TypeError(f"Cannot encode {type(value).__name__}")
+
+def decode_decimal(document):
+    return Decimal(document["$decimal"]) if document.keys() == {"$decimal"} else document
+
+def encode_transactions(transactions):
+    fields = dict.fromkeys(field for transaction in transactions for field in transaction)
+    document = {
+        "n": len(transactions),
+        "fields": {
+            field: pack_column([transaction.get(field, _MISSING) for transaction in transactions])
+            for field in fields
+        },
+    }
+    return zlib.compress(json.dumps(document, separators=(",", ":"), default=encode_decimal).encode("utf-8"), 6)
+
+def decode_transactions(payload):
+    document = json.loads(zlib.decompress(payload), object_hook=decode_decimal)
+    transactions = [{} for _ in range(document["n"])]
+    for field, column in document["fields"].items():
+        missing = set(column.get("missing", ()))
+        rows = [row for row in range(document["n"]) if row not in missing] if missing else range(document["n"])
+        for row, value in zip(rows, unpack_column(column)):
+            transactions[row][field] = value
+    return transactions
+
+def binary_bytes(value):
+    # The resource API hands binary attributes back wrapped in Binary.
+    return bytes(getattr(value, "value", value))
+
+def split_chunks(items, prefix=""):
+    # ([(key, head item)], {(key, chunk suffix): payload}), where key is the
+    # sort key without prefix and chunk suffix.
+    heads = []
+    chunks = {}
+    for item in items:
+        key, _, chunk = item["YearMonth"][len(prefix):].partition(CHUNK_SEPARATOR)
+        if chunk:
+            chunks[(key, chunk)] = item["payload"]
+        else:
+            heads.append((key, item))
+    return heads, chunks
+
+def chunked_payload(item, key, chunks):
+    parts = [item["payload"]]
+    for chunk in range(1, int(item.get("chunks", 1))):
+        suffix = f"{item.get('chunk_tag', '')}{chunk:03d}"
+        if (key, suffix) not in chunks:
+            raise ValueError(f"UserId {item.get('UserId')} {item['YearMonth']} is missing chunk {suffix}")
+        parts.append(chunks[(key, suffix)])
+    return b"".join(binary_bytes(part) for part in parts)
+
+def to_chunk_items(user_id, key, payload, revision=None):
+    # (head fields, chunk items) for a payload split into COMPACT_CHUNK_BYTES
+    # parts. Revisioned chunks get their own keys, so a write that loses the
+    # race for the head never clobbers the chunks of the one that won.
+    chunks = [payload[i:i + COMPACT_CHUNK_BYTES] for i in range(0, len(payload), COMPACT_CHUNK_BYTES)] or [b""]
+    chunk_tag = f"{revision}." if revision is not None else ""
+    head = {"format": COMPACT_FORMAT, "chunks": len(chunks), "payload": chunks[0]}
+    if revision is not None:
+        head["revision"] = revision
+        head["chunk_tag"] = chunk_tag
+    items = [
+        {"UserId": user_id, "YearMonth": f"{key}{CHUNK_SEPARATOR}{chunk_tag}{chunk:03d}", "payload": part}
+        for chunk, part in enumerate(chunks[1:], 1)
+    ]
+    return head, items
+
+def item_transactions(items):
+    # Transactions of a query's items, month by month, in either format.
+    return [transaction for transactions in month_transactions(items).values() for transaction in transactions]
+
+def month_transactions(items):
+    # {YearMonth: transactions} of a query's items.
+    heads, chunks = split_chunks(items)
+    months = {}
+    for year_month, item in heads:
+        if item.get("format") != COMPACT_FORMAT:
+            months[year_month] = item["transactions"]
+            continue
+        months[year_month] = decode_transactions(chunked_payload(item, year_month, chunks))
+    return months
+
+#### Rollups ####
+# Each persisted month also gets a "ROLLUP#<YearMonth>" item holding the
+# month's summary (see summarize_transactions) and its transaction id index.
+# It is rewritten with the month, so rollups stay in step without
+# read-modify-write, and with HISTORY_SOURCE=rollups a report reads one rollup
+# per month instead of the transactions. backfill_rollups (backfill.py
+# --rollups) covers months written before rollups existed.
+# A summary grows with the vendors and charges of the month and the index by
+# 8 bytes per transaction, so a rollup over ROLLUP_INLINE_BYTES is stored like
+# a compact month instead: the index followed by the zlib'd summary JSON,
+# split over "ROLLUP#<YearMonth>#<tag><n>" chunks under the 400 KB item limit.
+ROLLUP_PREFIX = "ROLLUP#"
+WRITE_ROLLUPS = os.environ.get("WRITE_ROLLUPS", "true").lower() == "true"
+ROLLUP_INLINE_BYTES = int(os.environ.get("ROLLUP_INLINE_BYTES", str(64 * 1024)))
+ROLLUP_PROJECTION = ("YearMonth", "rollup", "ids", "revision", "format", "chunks", "chunk_tag", "payload", "ids_bytes")
+# Without the inline summary, for re-upload checks that only need the ids.
+ROLLUP_INDEX_PROJECTION = ("YearMonth", "ids", "revision", "format", "chunks", "chunk_tag", "payload", "ids_bytes")
+
+def to_rollup_items(user_id, year_month, transactions, revision=None, summary=None):
+    # Any chunks first, then the rollup item that refers to them. summary is
+    # the month's summarize_transactions, when the caller already has it.
+    if summary is None:
+        summary = summarize_transactions(transactions)
+    ids = pack_transaction_ids(transactions)
+    head = {"UserId": user_id, "YearMonth": ROLLUP_PREFIX + year_month}
+    document = json.dumps(summary, separators=(",", ":")).encode("utf-8")
+    if len(document) + len(ids) <= ROLLUP_INLINE_BYTES:
+        head.update(rollup=summary, ids=ids)
+        if revision is not None:
+            head["revision"] = revision
+        return [head]
+    fields, chunks = to_chunk_items(user_id, head["YearMonth"], ids + zlib.compress(document), revision)
+    head.update(fields, ids_bytes=len(ids))
+    return chunks + [head]
+
+def read_rollups(items, summaries=True):
+    # {YearMonth: (summary, packed ids, revision, chunk keys)} from the rollup
+    # items of a query; summary is None when summaries is false.
+    heads, chunks = split_chunks(items, ROLLUP_PREFIX)
+    chunk_keys = {}
+    for year_month, chunk in chunks:
+        chunk_keys.setdefault(year_month, []).append(f"{ROLLUP_PREFIX}{year_month}{CHUNK_SEPARATOR}{chunk}")
+    rollups = {}
+    for year_month, item in heads:
+        revision = None if item.get("revision") is None else int(item["revision"])
+        if item.get("format") != COMPACT_FORMAT:
+            summary, ids = item.get("rollup"), binary_bytes(item.get("ids", b""))
+        else:
+            payload = chunked_payload(item, year_month, chunks)
+            ids_bytes = int(item["ids_bytes"])
+            summary = json.loads(zlib.decompress(payload[ids_bytes:])) if summaries else None
+            ids = payload[:ids_bytes]
+        rollups[year_month] = (summary, ids, revision, chunk_keys.get(year_month, []))
+    return rollups
+
+def backfill_rollups(user_id):
+    # Writes the rollup of every stored month of a user; returns the failures.
+    items = query_items(month_key_condition(user_id), HISTORY_PROJECTION + ("UserId",))
+    months = {}
+    for item in items:
+        months.setdefault(item["YearMonth"].partition(CHUNK_SEPARATOR)[0], []).append(item)
+    _, rollups = query_transaction_index(user_id)
+    results = write_months([
+        ("rollup", user_id, year_month, item_transactions(month_items), month_items[0].get("revision"),
+         rollups.get(year_month, (None, []))[1], None)
+        for year_month, month_items in months.items()
+    ])
+    return [result for result in results if not result["success"]]
+
+def to_dynamo_items(user_id, year_month, transactions, storage_format=STORAGE_FORMAT, rollups=WRITE_ROLLUPS, revision=None, summary=None):
+    # The month's head item first, then any overflow chunks, then the rollup.
+    rollup_items = to_rollup_items(user_id, year_month, transactions, revision, summary) if rollups else []
+    if storage_format != "compact":
+        head = to_dynamo_item(user_id, year_month, transactions)
+        if revision is not None:
+            head["revision"] = revision
+        return [head] + rollup_items
+    fields, chunks = to_chunk_items(user_id, year_month, encode_transactions(transactions), revision)
+    head = {"UserId": user_id, "YearMonth": year_month, "count": len(transactions), **fields}
+    return [head] + chunks + rollup_items
+
+def to_dynamo_item(user_id, year_month, transactions):
+    return {
+        "UserId": user_id,  # String directly
+        "YearMonth": year_month,  # String directly
+        "transactions": transactions  # List of dictionaries
+    }
+
+#### Idempotent ingest ####
+# A statement month is merged into what is already stored rather than
+# overwriting it: rows are matched by transaction id, a re-sent row replaces
+# the stored one and new rows are appended, so replays and corrected uploads
+# leave the totals right. Rows whose id was already ingested in another month
+# are dropped. Those ids come from an index kept in the rollup items: 8-byte
+# hashes of each month's ids, so a user's index is a set built from one small
+# attribute per month and every row is checked in O(1).
+# The head item of a month carries a revision and is written conditionally
+# on the revision the merge started from. If another writer got there first
+# the statement fails and its retry merges again. Months and rollups that are
+# already up to date are not rewritten.
+TRANSACTION_ID_BYTES = 8
+
+def transaction_id_hash(transaction_id):
+    return hashlib.blake2b(transaction_id.encode("utf-8"), digest_size=TRANSACTION_ID_BYTES).digest()
+
+def pack_transaction_ids(transactions):
+    return b"".join(sorted({transaction_id_hash(t["id"]) for t in transactions if t.get("id")}))
+
+def unpack_transaction_ids(packed):
+    data = binary_bytes(packed)
+    return {data[i:i + TRANSACTION_ID_BYTES] for i in range(0, len(data), TRANSACTION_ID_BYTES)}
+
+def query_month(user_id, year_month):
+    # The stored transactions of a month, the revision of its head item (None
+    # for a new month or one written before revisions) and its chunk keys.
+    items = query_items(month_key_condition(user_id, year_month, year_month), HISTORY_PROJECTION + ("UserId",))
+    heads = [item for item in items if item["YearMonth"] == year_month]
+    chunk_keys = [item["YearMonth"] for item in items if item["YearMonth"] != year_month]
+    if not heads:
+        return None, None, chunk_keys
+    revision = heads[0].get("revision")
+    return item_transactions(items), None if revision is None else int(revision), chunk_keys
+
+def query_transaction_index(user_id):
+    # (id hash -> YearMonths, YearMonth -> (rollup revision, rollup chunk keys))
+    # from the rollup items. An id is normally stored under one month, but
+    # months written before duplicates were dropped can share it.
+    items = query_items(Key("UserId").eq(user_id) & Key("YearMonth").begins_with(ROLLUP_PREFIX), ROLLUP_INDEX_PROJECTION)
+    index, rollups = {}, {}
+    for year_month, (_, ids, revision, chunk_keys) in read_rollups(items, summaries=False).items():
+        rollups[year_month] = (revision, chunk_keys)
+        for id_hash in unpack_transaction_ids(ids):
+            index.setdefault(id_hash, set()).add(year_month)
+    return index, rollups
+
+def dedupe_transactions(transactions, year_month, index, claimed=None):
+    # Drops repeated ids within the month, ids that an earlier month of the
+    # statement kept (claimed, id hash -> YearMonth) and ids stored only under
+    # other months.
+    seen = set()
+    unique = []
+    for transaction in transactions:
+        transaction_id = transaction.get("id")
+        if transaction_id:
+            id_hash = transaction_id_hash(transaction_id)
+            if id_hash in seen or (claimed or {}).get(id_hash, year_month) != year_month:
+                continue
+            if year_month not in index.get(id_hash, (year_month,)):
+                continue
+            seen.add(id_hash)
+        unique.append(transaction)
+    return unique
+
+def merge_transactions(stored, incoming):
+    merged = list(stored)
+    positions = {transaction["id"]: i for i, transaction in enumerate(stored) if transaction.get("id")}
+    for transaction in incoming:
+        position = positions.get(transaction.get("id"))
+        if position is None:
+            merged.append(transaction)
+        else:
+            merged[position] = transaction
+    return merged
+
+def plan_month(user_id, year_month, transactions, claimed=None):
+    # Returns the merged transactions and what has to be written:
+    # ("month", revision, old chunk keys), ("rollup", revision, old chunk keys)
+    # when only the rollup is behind, or None. A month that is not stored and
+    # whose rows were all duplicates of other months comes back empty.
+    index, rollups = query_transaction_index(user_id)
+    rollup_revision, rollup_chunk_keys = rollups.get(year_month, (_MISSING, []))
+    unique = dedupe_transactions(transactions, year_month, index, claimed)
+    if len(unique) < len(transactions):
+        print(f"Dropped {len(transactions) - len(unique)} duplicate transactions for UserId {user_id} YearMonth {year_month}")
+    stored, revision, chunk_keys = query_month(user_id, year_month)
+    if stored is None:
+        if not unique:
+            return unique, None
+        return unique, ("month", revision, chunk_keys + rollup_chunk_keys)
+    merged = merge_transactions(stored, unique)
+    if merged != stored:
+        return merged, ("month", revision, chunk_keys + rollup_chunk_keys)
+    if WRITE_ROLLUPS and rollup_revision != revision:
+        return merged, ("rollup", revision, rollup_chunk_keys)
+    return merged, None
+
+BATCH_WRITE_SIZE = 25  # BatchWriteItem limit
+BATCH_WRITE_MAX_ATTEMPTS = int(os.environ.get("BATCH_WRITE_MAX_ATTEMPTS", "8"))
+BATCH_WRITE_WORKERS = int(os.environ.get("BATCH_WRITE_WORKERS", "4"))
+RETRYABLE_WRITE_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "InternalServerError",
+}
+
+def batch_write_items(items, max_attempts=BATCH_WRITE_MAX_ATTEMPTS):
+    # Writes up to 25 items, resubmitting UnprocessedItems with exponential
+    # backoff and full jitter. Returns one result per item.
+    table = get_table()
+    pending = [{"PutRequest": {"Item": item}} for item in items]
+    error = None
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+        try:
+            with stage("dynamo_write") as timer:
+                response = table.meta.client.batch_write_item(RequestItems={table.name: pending})
+                timer.bytes = response_bytes(response)
+        except ClientError as e:
+            error = e.response["Error"]["Message"]
+            if e.response["Error"]["Code"] in RETRYABLE_WRITE_ERRORS:
+                continue
+            break
+        pending = response.get("UnprocessedItems", {}).get(table.name, [])
+        if not pending:
+            break
+        error = "Unprocessed after retries"
+
+    failed_keys = {
+        (request["PutRequest"]["Item"]["UserId"], request["PutRequest"]["Item"]["YearMonth"])
+        for request in pending
+    }
+    return [
+        {
+            "UserId": item["UserId"],
+            "YearMonth": item["YearMonth"],
+            "success": (item["UserId"], item["YearMonth"]) not in failed_keys,
+            "error": error if (item["UserId"], item["YearMonth"]) in failed_keys else None,
+        }
+        for item in items
+    ]
+
+def delete_chunks(keys):
+    # Best effort: a leftover chunk is never read, it only takes up space.
+    # keys are (UserId, YearMonth) pairs.
+    table = get_table()
+    for start in range(0, len(keys), BATCH_WRITE_SIZE):
+        requests = [
+            {"DeleteRequest": {"Key": {"UserId": user_id, "YearMonth": key}}}
+            for user_id, key in keys[start:start + BATCH_WRITE_SIZE]
+        ]
+        try:
+            table.meta.client.batch_write_item(RequestItems={table.name: requests})
+        except ClientError as e:
+            print(f"Error deleting old chunks: {e.response['Error']['Message']}")
+
+TRANSACT_WRITE_SIZE = 100  # TransactWriteItems limit
+TRANSACT_WRITE_BYTES = 4 * 1024 * 1024  # and its limit on the items' total size
+
+def item_size(item):
+    # Roughly DynamoDB's size of an item: names plus values, binary ones by
+    # length and the rest as JSON.
+    return sum(
+        len(name) + (len(binary_bytes(value)) if isinstance(value, bytes) or hasattr(value, "value") else len(json.dumps(value, default=str)))
+        for name, value in item.items()
+    )
+
+def revision_condition(revision):
+    # The head's revision has not moved since the merge read it. Written out,
+    # since boto3 does not translate conditions inside TransactItems.
+    if revision is None:
+        return {"ConditionExpression": "attribute_not_exists(#revision)", "ExpressionAttributeNames": {"#revision": "revision"}}
+    return {
+        "ConditionExpression": "#revision = :revision",
+        "ExpressionAttributeNames": {"#revision": "revision"},
+        "ExpressionAttributeValues": {":revision": revision},
+    }
+
+def transact_heads(heads, max_attempts=BATCH_WRITE_MAX_ATTEMPTS):
+    # Puts head items, each on its condition ([(item, condition)]), in one
+    # TransactWriteItems. A cancelled transaction reports a reason per item:
+    # the items that failed their condition (or failed outright) are dropped
+    # and the rest resubmitted. Returns {(UserId, YearMonth): error or None}.
+    table = get_table()
+    errors = {}
+    pending = list(heads)
+    error = None
+    for attempt in range(max_attempts):
+        if not pending:
+            break
+        if attempt:
+            time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+        try:
+            with stage("dynamo_write") as timer:
+                response = table.meta.client.transact_write_items(TransactItems=[
+                    {"Put": {"TableName": table.name, "Item": item, **condition}}
+                    for item, condition in pending
+                ])
+                timer.bytes = response_bytes(response)
+        except ClientError as e:
+            error = e.response["Error"]["Message"]
+            if e.response["Error"]["Code"] != "TransactionCanceledException":
+                if e.response["Error"]["Code"] in RETRYABLE_WRITE_ERRORS:
+                    continue
+                break
+            reasons = e.response.get("CancellationReasons", [])
+            if len(reasons) != len(pending):
+                continue
+            retry = []
+            for (item, condition), reason in zip(pending, reasons):
+                code = reason.get("Code", "None")
+                if code == "ConditionalCheckFailed":
+                    errors[item["UserId"], item["YearMonth"]] = "Month was updated concurrently"
+                elif code in ("None", "TransactionConflict", "ThrottlingError", "ProvisionedThroughputExceeded"):
+                    retry.append((item, condition))
+                else:
+                    errors[item["UserId"], item["YearMonth"]] = reason.get("Message", code)
+            pending = retry
+            continue
+        errors.update(((item["UserId"], item["YearMonth"]), None) for item, _ in pending)
+        pending = []
+    for item, _ in pending:
+        errors[item["UserId"], item["YearMonth"]] = error or "Unprocessed after retries"
+    return errors
+
+def write_months(months, max_attempts=BATCH_WRITE_MAX_ATTEMPTS):
+    # Writes a batch of months, each ("month" or "rollup", UserId, YearMonth,
+    # transactions, revision, old chunk keys, summary); "rollup" only catches
+    # the rollup up with the stored head. The chunks go first, then the heads
+    # in transactions of up to TRANSACT_WRITE_SIZE, each on the condition that
+    # its revision has not moved since the merge read it, then the rollups of
+    # the months whose head was written, batched across months, and last the
+    # chunks the previous revisions used. Returns one result per item.
+    chunks, heads, rollups, replaced = [], [], [], {}
+    for kind, user_id, year_month, transactions, revision, old_chunk_keys, summary in months:
+        if kind == "rollup":
+            items = to_rollup_items(user_id, year_month, transactions, revision, summary)
+            rollups.append(((user_id, year_month), items))
+        else:
+            items = to_dynamo_items(user_id, year_month, transactions, revision=(revision or 0) + 1, summary=summary)
+            heads.append((items[0], revision_condition(revision)))
+            chunks.extend(item for item in items[1:] if not item["YearMonth"].startswith(ROLLUP_PREFIX))
+            rollups.append(((user_id, year_month), [item for item in items[1:] if item["YearMonth"].startswith(ROLLUP_PREFIX)]))
+        written = {item["YearMonth"] for item in items}
+        replaced[user_id, year_month] = [(user_id, key) for key in old_chunk_keys if key not in written]
+
+    results = []
+    for start in range(0, len(chunks), BATCH_WRITE_SIZE):
+        results.extend(batch_write_items(chunks[start:start + BATCH_WRITE_SIZE], max_attempts))
+    failed_chunks = {
+        (result["UserId"], result["YearMonth"].partition(CHUNK_SEPARATOR)[0])
+        for result in results if not result["success"]
+    }
+    errors = {}
+    group, group_bytes = [], 0
+    for head, condition in heads + [(None, None)]:
+        key = None if head is None else (head["UserId"], head["YearMonth"])
+        if key in failed_chunks:
+            errors[key] = "Failed to write the month's chunks"
+            continue
+        size = 0 if head is None else item_size(head)
+        if group and (head is None or len(group) == TRANSACT_WRITE_SIZE or group_bytes + size > TRANSACT_WRITE_BYTES):
+            errors.update(transact_heads(group, max_attempts))
+            group, group_bytes = [], 0
+        if head is not None:
+            group.append((head, condition))
+            group_bytes += size
+    results.extend(
+        {"UserId": user_id, "YearMonth": year_month, "success": error is None, "error": error}
+        for (user_id, year_month), error in errors.items()
+    )
 
-        print("Successfully formatted new transactions for DynamoDB.")
-        return dynamo_data
+    # A rollup only follows a head that was written ("rollup" months have none here).
+    rollup_items, stale = [], []
+    for key, items in rollups:
+        if errors.get(key) is None:
+            rollup_items.extend(items)
+    rollup_results = []
+    for start in range(0, len(rollup_items), BATCH_WRITE_SIZE):
+        rollup_results.extend(batch_write_items(rollup_items[start:start + BATCH_WRITE_SIZE], max_attempts))
+    results.extend(rollup_results)
+    failed_rollups = {
+        (result["UserId"], result["YearMonth"][len(ROLLUP_PREFIX):].partition(CHUNK_SEPARATOR)[0])
+        for result in rollup_results if not result["success"]
+    }
+    for key, chunk_keys in replaced.items():
+        # The old chunks stay while the old rollup may still refer to them.
+        if errors.get(key) is None and key not in failed_rollups:
+            stale.extend(chunk_keys)
+    delete_chunks(stale)
+    return results
+
+class StatementWriter:
+    # Collects the months of a statement into batches of TRANSACT_WRITE_SIZE
+    # and writes each batch with write_months on a small thread pool, keeping
+    # at most two batches per worker in flight.
+    def __init__(self, max_workers=BATCH_WRITE_WORKERS):
+        self.scope = current_scope()  # the writes are timed as part of the statement
+        self.max_in_flight = max_workers * 2
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.months = []
+        self.in_flight = []
+        self.results = []
+
+    def add_month(self, user_id, year_month, transactions, revision, old_chunk_keys=(), summary=None):
+        self._add(("month", user_id, year_month, transactions, revision, old_chunk_keys, summary))
+
+    def add_rollup(self, user_id, year_month, transactions, revision, old_chunk_keys=(), summary=None):
+        self._add(("rollup", user_id, year_month, transactions, revision, old_chunk_keys, summary))
+
+    def _add(self, month):
+        self.months.append(month)
+        if len(self.months) >= TRANSACT_WRITE_SIZE:
+            self._submit()
+
+    def _submit(self):
+        if len(self.in_flight) >= self.max_in_flight:
+            self.results.extend(self.in_flight.pop(0).result())
+        months, self.months = self.months, []
+        self.in_flight.append(self.executor.submit(self._write, months))
+
+    def _write(self, months):
+        _metrics_state.scopes = [self.scope] if self.scope else []
+        return write_months(months)
+
+    def close(self):
+        if self.months:
+            self._submit()
+        for future in self.in_flight:
+            self.results.extend(future.result())
+        self.in_flight = []
+        self.executor.shutdown()
+        return self.results
+
+    def failures(self):
+        return [result for result in self.results if not result["success"]]
+
+def build_user_report(user_id, year_month, current_transactions, history, recurring=None):
+    # history is the summary from query_history; only the current month is
+    # needed as transactions. recurring is the report's detected_recurring
+    # result when the caller detected a block of reports at once.
+    with metrics_scope(UserId=user_id, YearMonth=year_month), report_profiler(user_id, year_month), stage("report"):
+        with stage("analysis.batch"):
+            batch = TransactionBatch(current_transactions)
+            current_rows = batch.rows()
+        with stage("analysis.home_country"):
+            home_country = summary_home_country(history)
+        with stage("analysis.average"):
+            historical_average = summary_average(history)
+        with stage("analysis.risk"):
+            flagged_transactions = score_risk(batch, current_rows, history, home_country, historical_average)
+        with stage("analysis.spending_by_category"):
+            spending_by_cat = batch.spending_by_category(current_rows)
+            previous_month = shift_year_month(year_month, -1)
+            spending_by_cat_prev = to_amounts(add_cents(
+                summary_month_categories(history, previous_month),
+                batch.category_cents(batch.rows_in_month(current_rows, previous_month)),
+            ))
+        with stage("chart.pie"):
+            pie_chart = generate_pie_chart(spending_by_cat, spending_by_cat_prev, user_id, year_month)
+        with stage("analysis.high_value"):
+            high_value_transaction = high_value_records(batch, batch.rows_above(current_rows, historical_average))
+        with stage("analysis.recurring"):
+            current_year = year_month[:4]
+            if RECURRING_SOURCE == "detect":
+                if recurring is None:
+                    recurring = detected_recurring([(batch, current_rows, history, year_month)])[0]
+                recurring_cents, recurring_forecasts = recurring
+                recurring_transactions_summary = to_amounts(recurring_cents)
+            else:
+                recurring_forecasts = None
+                recurring_transactions_summary = to_amounts(add_cents(
+                    batch.recurring_cents(current_rows, current_year), summary_recurring(history, current_year)
+                ))
+        with stage("analysis.trend"):
+            monthly_spending = add_cents(batch.monthly_cents(current_rows), dict(history["months"]))
+            monthly_spending_trend = spending_trend(to_amounts(monthly_spending))
+        with stage("chart.trend"):
+            trend_chart = generate_bar_line_chart(monthly_spending_trend["MonthlySpending"], user_id, year_month)
+        report = {
+            "UserId": user_id,
+            "YearMonth": year_month,
+            "FlaggedTransactions": flagged_transactions,
+            "SpendingByCategory": spending_by_cat,
+            "HighValueTransaction": high_value_transaction,
+            "RecurringTransactionsYearToDate": recurring_transactions_summary,
+            "MonthlySpending_Trend": monthly_spending_trend,
+        }
+        if recurring_forecasts is not None:
+            report["RecurringTransactionsForecast"] = recurring_forecasts
+        with stage("chart.recurring"):
+            recurring_graph = generate_recurring_transactions_graph(report["RecurringTransactionsYearToDate"], user_id, year_month, recurring_forecasts)
+
+        with stage("pdf") as timer:
+            pdf_report = generate_pdf_report(user_id, year_month, pie_chart, trend_chart, recurring_graph, high_value_transaction, flagged_transactions)
+            timer.bytes = len(pdf_report)
+        return report, pdf_report
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", str(available_cpus())))
+
+def render_worker(connection):
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        index, args = task
+        try:
+            connection.send((index, build_user_report(*args), None))
+        except Exception as e:
+            connection.send((index, None, f"{type(e).__name__}: {e}"))
+    connection.close()
+
+class RenderPool:
+    # Spreads build_user_report over worker processes. multiprocessing.Pool and
+    # ProcessPoolExecutor need /dev/shm, which Lambda does not have, so the
+    # workers are plain Processes fed over Pipes. The pool is shared by the
+    # threads processing a batch of statements: submit() hands back a ticket,
+    # result() waits for it, and an exception only fails its own task.
+    def __init__(self, workers=RENDER_WORKERS):
+        self.workers = workers
+        self.started = False
+        self.condition = threading.Condition()
+        self.receiving = False
+        self.connections = []
+        self.processes = []
+        self.idle = []
+        self.tasks = {}
+        self.completed = {}
+        self.submitted = 0
+        # Rendering in this process is serialized: the chart templates are shared.
+        self.inline_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def start(self):
+        # Called by the first submit(), so an invocation with nothing to render
+        # starts no workers. By then other threads are running, and forking
+        # this process would copy locks they hold, locked for good. The workers
+        # are forked by a forkserver instead: a fresh process, started without
+        # forking this one, that imports the rendering modules once for all of
+        # them. Vector charts never import matplotlib.
+        with self.condition:
+            if self.workers <= 1 or self.started:
+                return
+            self.started = True
+            preload = [__name__, "fpdf", "pycountry"]
+            if CHART_MODE != "vector":
+                os.environ.setdefault("MPLCONFIGDIR", "/tmp")  # see matplotlib_figure
+                preload += ["matplotlib.figure", "matplotlib.backends.backend_agg"]
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(preload)
+            try:
+                for _ in range(self.workers):
+                    parent_connection, child_connection = context.Pipe()
+                    process = context.Process(target=render_worker, args=(child_connection,), daemon=True)
+                    process.start()
+                    child_connection.close()
+                    self.connections.append(parent_connection)
+                    self.processes.append(process)
+            except OSError as e:
+                # Render in this process with whatever workers did start.
+                print(f"Error starting render workers: {e}")
+            self.idle = list(self.connections)
+
+    def __exit__(self, *exc_info):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for connection in self.connections:
+            connection.close()
+
+    def _receive(self):
+        # Called with the condition held. Only one thread waits on the pipes at
+        # a time; the others wait to be notified about what it received.
+        busy = [connection for connection in self.connections if connection not in self.idle]
+        if self.receiving or not busy:
+            self.condition.wait()
+            return
+        self.receiving = True
+        self.condition.release()
+        try:
+            ready = multiprocessing.connection.wait(busy)
+        finally:
+            self.condition.acquire()
+            self.receiving = False
+        for connection in ready:
+            try:
+                index, result, error = connection.recv()
+            except EOFError:
+                # The worker died (e.g. out of memory); fail its task and retire it.
+                index = next(i for i, c in self.tasks.items() if c is connection)
+                result, error = None, "Render worker exited unexpectedly"
+                self.connections.remove(connection)
+            else:
+                self.idle.append(connection)
+            del self.tasks[index]
+            self.completed[index] = (result, error)
+        self.condition.notify_all()
+
+    def submit(self, user_id, year_month, current_transactions, history, recurring=None):
+        args = (user_id, year_month, current_transactions, history, recurring)
+        self.start()
+        with self.condition:
+            index = self.submitted
+            self.submitted += 1
+            while self.connections and not self.idle:
+                self._receive()
+            if self.connections:
+                connection = self.idle.pop()
+                connection.send((index, args))
+                self.tasks[index] = connection
+                return index
+        # Single CPU, or every worker has died: render in this process.
+        with self.inline_lock:
+            try:
+                outcome = (build_user_report(*args), None)
+            except Exception as e:
+                outcome = (None, f"{type(e).__name__}: {e}")
+        with self.condition:
+            self.completed[index] = outcome
+            self.condition.notify_all()
+        return index
+
+    def poll(self, index):
+        with self.condition:
+            return self.completed.pop(index, None)
+
+    def result(self, index):
+        with self.condition:
+            while index not in self.completed:
+                self._receive()
+            return self.completed.pop(index)
+
+_render_pool = None
+
+def render_pool():
+    # One pool per container: its workers serve every invocation.
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = RenderPool()
+    return _render_pool
+
+MAX_CONCURRENT_RECORDS = int(os.environ.get("MAX_CONCURRENT_RECORDS", "4"))
+
+# Statements are pipelined: while a report renders, the history of the next
+# PREFETCH_DEPTH users is fetched and checked against the report cache, and
+# finished reports upload in the background, so network waits overlap with
+# rendering instead of adding to it. Both queues are bounded to cap memory.
+PREFETCH_DEPTH = int(os.environ.get("PREFETCH_DEPTH", "8"))
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", "4"))
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "4"))
+
+class StatementMonths:
+    # The months of the statement being ingested, by user, as they are merged:
+    # the packed ids each one kept, its summary and its amounts (see
+    # query_history). A group only sees the groups of its user
+    # that came before it in the statement, which need not be written yet.
+    # Those were submitted to the prefetcher first, so they are already
+    # running when a later group waits for them. A failed month is None.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.users = {}
+
+    def reserve(self, user_id, year_month):
+        # Called in statement order; returns the user's months before this one.
+        with self.condition:
+            months = self.users.setdefault(user_id, {})
+            earlier = list(months)
+            months[year_month] = _MISSING
+            return earlier
+
+    def wait(self, user_id, year_months):
+        with self.condition:
+            months = self.users[user_id]
+            self.condition.wait_for(lambda: all(months[month] is not _MISSING for month in year_months))
+            records = {month: months[month] for month in year_months}
+        if any(record is None for record in records.values()):
+            raise RuntimeError(f"An earlier month of UserId {user_id} failed")
+        return records
+
+    def add(self, user_id, year_month, record):
+        with self.condition:
+            self.users[user_id][year_month] = record
+            self.condition.notify_all()
+
+def prepare_report(user_id, year_month, current_transactions, force=False, statement=None, earlier=()):
+    # The I/O before a render: merging with the stored month, the history, its
+    # digest and the cache check. force renders even when the cache is current.
+    # statement (StatementMonths) holds the earlier months of the statement.
+    with metrics_scope(UserId=user_id, YearMonth=year_month):
+        record = None
+        try:
+            earlier_months = statement.wait(user_id, earlier) if earlier else {}
+            claimed = {}
+            for month, (ids, _, _) in earlier_months.items():
+                claimed.update(dict.fromkeys(unpack_transaction_ids(ids), month))
+            with stage("merge"):
+                current_transactions, write = plan_month(user_id, year_month, current_transactions, claimed)
+            # Summarized once for the later months' history and the rollup write.
+            summary = summarize_transactions(current_transactions) if current_transactions else None
+            if write:
+                write += (summary,)
+            amounts = np.array([float(t["amount"]) for t in current_transactions])
+            record = (pack_transaction_ids(current_transactions), summary, amounts)
+        finally:
+            if statement:
+                statement.add(user_id, year_month, record)
+        if not current_transactions:
+            return current_transactions, write, None, None, True
+        history = query_history(user_id, year_month, statement_months=earlier_months)
+        with stage("digest"):
+            digest = report_digest(user_id, year_month, current_transactions, history)
+        with stage("cache_check"):
+            up_to_date = not force and report_is_current(report_s3_key(user_id, year_month, "pdf"), digest)
+    return current_transactions, write, history, digest, up_to_date
+
+def publish_report(user_id, year_month, report, pdf_report, digest):
+    with metrics_scope(UserId=user_id, YearMonth=year_month):
+        uploaded = True
+        if UPLOAD_JSON_REPORT:
+            report_json = json.dumps(report, indent=2).encode("utf-8")
+            uploaded = upload_to_s3(report_json, REPORTS_BUCKET, report_s3_key(user_id, year_month, "json"), "application/json")
+        # The PDF goes last: its digest marks the whole report as published.
+        pdf_s3_key = report_s3_key(user_id, year_month, "pdf")
+        uploaded = uploaded and upload_to_s3(pdf_report, REPORTS_BUCKET, pdf_s3_key, metadata={"report-digest": digest})
+        if uploaded:
+            remember_report(pdf_s3_key, digest)
+        return uploaded
+
+def process_statement(ingest_bucket, file_key, pool, groups=None, delete=True, force=False, exporter=None):
+    # Ingests one statement object. Returns None on success or an error message.
+    # groups replaces the S3 object as the source (e.g. a local file); delete
+    # and force are for batch runs that keep their sources or re-render. The
+    # results of published reports are added to exporter, if any.
+    writer = StatementWriter()
+    statement = StatementMonths()
+    prefetcher = uploader = None
+    try:
+        failed_reports = []
+        digests = {}
+        prefetched = deque()  # (key, future of prepare_report)
+        pending = deque()  # (key, render ticket)
+        detect_block = []  # (key, transactions, history) awaiting detected_recurring
+        uploads = deque()  # (key, future of publish_report, report)
+
+        def prefetch(key, current_transactions):
+            nonlocal prefetcher
+            if prefetcher is None:
+                prefetcher = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+            earlier = statement.reserve(*key)
+            return prefetcher.submit(prepare_report, *key, current_transactions, force, statement, earlier)
+
+        def dispatch(key, prepared):
+            current_transactions, write, history, digest, up_to_date = prepared.result()
+            if not current_transactions:
+                print(f"No new transactions for UserId {key[0]} YearMonth {key[1]}; skipping")
+                return
+            ####### Uplodad to Dynamo  #######
+            if write and write[0] == "month":
+                writer.add_month(*key, current_transactions, *write[1:])
+            elif write:
+                writer.add_rollup(*key, current_transactions, *write[1:])
+            if up_to_date:
+                print(f"Report for UserId {key[0]} YearMonth {key[1]} is up to date; skipping render")
+                return
+            digests[key] = digest
+            if RECURRING_SOURCE != "detect":
+                pending.append((key, pool.submit(*key, current_transactions, history)))
+                return
+            detect_block.append((key, current_transactions, history))
+            if len(detect_block) >= RECURRING_BLOCK_REPORTS:
+                submit_block()
+
+        def submit_block():
+            # Detects the recurring charges of the block in one pass; the
+            # workers then get the histories without their charges.
+            with stage("recurring"):
+                batches = [TransactionBatch(current_transactions) for _, current_transactions, _ in detect_block]
+                recurring = detected_recurring([
+                    (batch, batch.rows(), history, key[1])
+                    for batch, (key, _, history) in zip(batches, detect_block)
+                ])
+            for (key, current_transactions, history), report_recurring in zip(detect_block, recurring):
+                pending.append((key, pool.submit(*key, current_transactions, dict(history, charges=[]), report_recurring)))
+            detect_block.clear()
+
+        def publish(key, result, error):
+            nonlocal uploader
+            digest = digests.pop(key)
+            if error:
+                failed_reports.append(key)
+                print(f"Error generating report for UserId {key[0]} YearMonth {key[1]}: {error}")
+                return
+            if uploader is None:
+                uploader = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+            while len(uploads) >= 2 * UPLOAD_WORKERS:
+                collect_upload(*uploads.popleft())
+            uploads.append((key, uploader.submit(publish_report, *key, *result, digest), result[0]))
+
+        def collect_upload(key, uploaded, report):
+            if not uploaded.result():
+                failed_reports.append(key)
+            elif exporter:
+                exporter.add(report)
+
+        def publish_rendered(block):
+            # Publish in submission order; block once too many reports are
+            # outstanding so rendered PDFs cannot pile up in memory.
+            while pending:
+                key, index = pending[0]
+                outcome = pool.result(index) if block or len(pending) > 2 * max(pool.workers, 1) else pool.poll(index)
+                if outcome is None:
+                    break
+                pending.popleft()
+                publish(key, *outcome)
+
+        # Each (UserId, YearMonth) group is parsed once and shared by the analysis
+        # and the DynamoDB write, so the statement never has to fit in memory.
+        if groups is None:
+            groups = stream_statement_groups(ingest_bucket, file_key)
+        for key, current_transactions in groups:
+            prefetched.append((key, prefetch(key, current_transactions)))
+            while len(prefetched) > PREFETCH_DEPTH:
+                dispatch(*prefetched.popleft())
+            publish_rendered(block=False)
+        while prefetched:
+            dispatch(*prefetched.popleft())
+            publish_rendered(block=False)
+        if detect_block:
+            submit_block()
+        publish_rendered(block=True)
+        while uploads:
+            collect_upload(*uploads.popleft())
+        for executor in (prefetcher, uploader):
+            if executor:
+                executor.shutdown()
+
+        writer.close()
+        failed_writes = writer.failures()
+        if failed_writes:
+            # Keep the statement in the ingestion bucket so it can be retried.
+            for failure in failed_writes:
+                print(f"Failed to write UserId {failure['UserId']} YearMonth {failure['YearMonth']}: {failure['error']}")
+            return f"Failed to persist {len(failed_writes)} of {len(writer.results)} items."
+        if failed_reports:
+            return f"Failed to generate {len(failed_reports)} reports."
+        if delete:
+            delete_statement(ingest_bucket, file_key)
+        return None
 
     except Exception as e:
-        print(f"Error loading new transactions: {str(e)}")
-        return []
+        for executor in (writer.executor, prefetcher, uploader):
+            if executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+        print(f"Error processing {ingest_bucket}/{file_key}: {str(e)}")
+        return "An error occurred."
+
+def delete_statement(ingest_bucket, file_key):
+    get_s3_client().delete_object(Bucket=ingest_bucket, Key=file_key)
+    print(f"Deleted processed file: {file_key} from bucket: {ingest_bucket}")
+
+def delete_exported(objects, errors):
+    # Deletes the statements that were held back until their export was
+    # uploaded; returns errors with the ones that could not be deleted.
+    errors = list(errors)
+    for number, ((_, bucket_name, key), error) in enumerate(zip(objects, errors)):
+        if error or bucket_name is None:
+            continue
+        try:
+            delete_statement(bucket_name, key)
+        except ClientError as e:
+            print(f"Error deleting {bucket_name}/{key}: {e.response['Error']['Message']}")
+            errors[number] = "Failed to delete the statement."
+    return errors
+
+def s3_record_objects(s3_records):
+    return [(s3_record["s3"]["bucket"]["name"], unquote_plus(s3_record["s3"]["object"]["key"])) for s3_record in s3_records]
+
+def statement_objects(event):
+    # Yields (item identifier, bucket, key) for every object in an S3
+    # notification or in the S3 notifications carried by an SQS batch. An SQS
+    # message that cannot be parsed yields (identifier, None, None), so that
+    # only it is reported as failed.
+    for record in event.get("Records", []):
+        if record.get("eventSource") == "aws:sqs":
+            identifier = record["messageId"]
+            try:
+                body = json.loads(record["body"])
+                body = json.loads(body["Message"]) if "Message" in body else body  # SNS fan-out
+                objects = s3_record_objects(body.get("Records", []))  # s3:TestEvent has none
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                print(f"Error parsing message {identifier}: {type(e).__name__}: {e}")
+                yield identifier, None, None
+                continue
+        else:
+            identifier = None
+            objects = s3_record_objects([record])
+        for bucket, key in objects:
+            yield identifier or f"{bucket}/{key}", bucket, key
+
+#### Sharded fan-out ####
+# With SHARD_BUCKET set, a statement larger than SHARD_THRESHOLD_BYTES is not
+# processed by the invocation that received it. The coordinator streams it
+# into CSV shards of about SHARD_TARGET_BYTES, cut only where the UserId
+# changes, so each user's months stay together and in order. Each shard is
+# uploaded to SHARD_BUCKET and handed to a dispatcher as soon as it is
+# complete. A shard worker processes its shard like a statement and deletes
+# it once its writes and reports are in. The lambda dispatcher invokes the
+# workers asynchronously and the coordinator returns once they are queued, so
+# the fan-out is not bounded by its own timeout: each worker that succeeds
+# adds its shard to a tracker item, the coordinator records the shard count
+# on it, and whichever of those updates completes it deletes the original and
+# the tracker. A failed worker is retried by Lambda; one that keeps failing
+# leaves the original in place to be sent again, and the shards that already
+# went through are no-ops the second time (see "Idempotent ingest"). The
+# local dispatcher waits for its shards and deletes the original itself.
+# SHARD_BUCKET must not trigger this function.
+SHARD_BUCKET = os.environ.get("SHARD_BUCKET", "")
+SHARD_PREFIX = os.environ.get("SHARD_PREFIX", "shards/")
+SHARD_THRESHOLD_BYTES = int(os.environ.get("SHARD_THRESHOLD_BYTES", str(64 * 1024 * 1024)))
+SHARD_TARGET_BYTES = int(os.environ.get("SHARD_TARGET_BYTES", str(16 * 1024 * 1024)))
+# "lambda" invokes SHARD_FUNCTION per shard; "local" runs the shards in this
+# process, e.g. against the stand-ins or on a large machine.
+SHARD_DISPATCHER = os.environ.get("SHARD_DISPATCHER", "lambda")
+SHARD_FUNCTION = os.environ.get("SHARD_FUNCTION", os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""))
+SHARD_CONCURRENCY = int(os.environ.get("SHARD_CONCURRENCY", "16"))
+SHARD_TRACKER_PREFIX = "SHARDS#"  # tracker items: UserId "SHARDS#<bucket>/<key>", YearMonth <run id>
+
+def statement_size(bucket_name, key):
+    try:
+        return get_s3_client().head_object(Bucket=bucket_name, Key=key)["ContentLength"]
+    except ClientError:
+        return 0  # let process_statement report it
+
+def split_statement(bucket_name, key, run_id, target_bytes=SHARD_TARGET_BYTES):
+    # Uploads the shards of a statement one at a time; yields each shard's key.
+    # The keys include run_id, so a retried split never overwrites the shards
+    # of an earlier one that may still be running.
+    response = get_s3_client().get_object(Bucket=bucket_name, Key=key)
+    reader = csv.reader(io.TextIOWrapper(response["Body"], encoding="utf-8-sig", newline=""))
+    header = next(reader, None)
+    if header is None:
+        return
+    if "UserId" not in header:
+        raise ValueError("Statement is missing columns: UserId")
+    user_column = header.index("UserId")
+
+    def upload(index, buffer):
+        shard_key = f"{SHARD_PREFIX}{key}/{run_id}/{index:05d}.csv"
+        if not upload_to_s3(buffer.getvalue().encode("utf-8"), SHARD_BUCKET, shard_key, "text/csv"):
+            raise RuntimeError(f"Failed to upload shard {shard_key}")
+        return shard_key
+
+    index, buffer, user_id = 0, None, None
+    for row in reader:
+        if not row:
+            continue  # blank lines, as iter_statement_groups skips them
+        if buffer is None or (row[user_column] != user_id and buffer.tell() >= target_bytes):
+            if buffer is not None:
+                yield upload(index, buffer)
+                index += 1
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(header)
+        user_id = row[user_column]
+        writer.writerow(row)
+    if buffer is not None:
+        yield upload(index, buffer)
+
+class LambdaDispatcher:
+    # Queues every shard as an asynchronous invocation of function_name;
+    # completion is tracked on the tracker item (see complete_shard).
+    tracked = True
+
+    def __init__(self, function_name=SHARD_FUNCTION, concurrency=SHARD_CONCURRENCY):
+        self.function_name = function_name
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def submit(self, bucket_name, key, statement):
+        return self.executor.submit(self.invoke, bucket_name, key, statement)
+
+    def invoke(self, bucket_name, key, statement):
+        # None once the invocation is queued, otherwise an error message.
+        try:
+            get_lambda_client().invoke(
+                FunctionName=self.function_name,
+                InvocationType="Event",
+                Payload=json.dumps({"shard": {"bucket": bucket_name, "key": key, "statement": statement}}).encode("utf-8"),
+            )
+        except Exception as e:  # throttling fails the shard, not the coordinator
+            return str(e)
+        return None
+
+    def close(self):
+        self.executor.shutdown()
+
+class LocalDispatcher:
+    # Runs the shards on threads of this process, rendering on its pool.
+    tracked = False
+
+    def __init__(self, pool, exporter=None, concurrency=MAX_CONCURRENT_RECORDS):
+        self.pool = pool
+        self.exporter = exporter
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def submit(self, bucket_name, key, statement):
+        return self.executor.submit(process_statement, bucket_name, key, self.pool, exporter=self.exporter)
+
+    def close(self):
+        self.executor.shutdown()
+
+def make_dispatcher(pool, exporter=None, kind=SHARD_DISPATCHER):
+    if kind == "local":
+        return LocalDispatcher(pool, exporter)
+    return LambdaDispatcher()
+
+def coordinate_statement(ingest_bucket, file_key, dispatcher, delete=True):
+    # Fans a statement out over shards. Returns None on success or an error
+    # message; with a tracked dispatcher, success means every shard is queued.
+    run_id = uuid.uuid4().hex
+    statement = {"bucket": ingest_bucket, "key": file_key, "run": run_id, "delete": delete}
+    shards = []
+    error = None
+    try:
+        for shard_key in split_statement(ingest_bucket, file_key, run_id):
+            shards.append((shard_key, dispatcher.submit(SHARD_BUCKET, shard_key, statement)))
+    except Exception as e:
+        print(f"Error splitting {ingest_bucket}/{file_key}: {str(e)}")
+        error = "An error occurred."
+    failed = 0
+    for shard_key, future in shards:
+        shard_error = future.result()
+        if shard_error:
+            failed += 1
+            print(f"Failed shard {SHARD_BUCKET}/{shard_key}: {shard_error}")
+    dispatcher.close()
+    print(f"Dispatched {len(shards)} shards of {ingest_bucket}/{file_key}; {failed} failed")
+    if error or failed:
+        return error or f"Failed to process {failed} of {len(shards)} shards."
+    if dispatcher.tracked:
+        return track_shards(statement, len(shards))
+    if delete:
+        delete_statement(ingest_bucket, file_key)
+    return None
+
+def shard_tracker_key(statement):
+    return {"UserId": f"{SHARD_TRACKER_PREFIX}{statement['bucket']}/{statement['key']}", "YearMonth": statement["run"]}
+
+def track_shards(statement, total):
+    # Records the shard count once every shard is queued; the shards may all
+    # have finished already.
+    table = get_table()
+    try:
+        response = table.meta.client.update_item(
+            TableName=table.name,
+            Key=shard_tracker_key(statement),
+            UpdateExpression="SET #total = :total",
+            ExpressionAttributeNames={"#total": "total"},
+            ExpressionAttributeValues={":total": total},
+            ReturnValues="ALL_OLD",
+        )
+    except ClientError as e:
+        print(f"Error tracking the shards of {statement['bucket']}/{statement['key']}: {e.response['Error']['Message']}")
+        return "An error occurred."
+    if len(response.get("Attributes", {}).get("done", ())) >= total:
+        finish_statement(statement)
+    return None
+
+def complete_shard(shard):
+    # Adds a finished shard to its statement's tracker. The one update that
+    # finds the count reached for the first time finishes the statement.
+    statement = shard["statement"]
+    table = get_table()
+    response = table.meta.client.update_item(
+        TableName=table.name,
+        Key=shard_tracker_key(statement),
+        UpdateExpression="ADD #done :shard",
+        ExpressionAttributeNames={"#done": "done"},
+        ExpressionAttributeValues={":shard": {shard["key"]}},
+        ReturnValues="ALL_OLD",
+    )
+    old = response.get("Attributes", {})
+    if "total" not in old:
+        return  # the coordinator has not counted the shards yet
+    done = set(old.get("done", ()))
+    if len(done) < int(old["total"]) <= len(done | {shard["key"]}):
+        finish_statement(statement)
+
+def finish_statement(statement):
+    print(f"All shards of {statement['bucket']}/{statement['key']} are done")
+    if statement["delete"]:
+        delete_statement(statement["bucket"], statement["key"])
+    table = get_table()
+    table.meta.client.delete_item(TableName=table.name, Key=shard_tracker_key(statement))
+
+def handle_shard(shard):
+    # Entry point of a shard worker invocation. It is asynchronous, so a
+    # failure is raised for Lambda to retry it.
+    exporter = ResultExporter() if EXPORT_BUCKET else None
+    objects = [(None, shard["bucket"], shard["key"])]
+    with metrics_scope(Bucket=shard["bucket"], Key=shard["key"]), stage("statement"):
+        errors = [process_statement(shard["bucket"], shard["key"], render_pool(), delete=not exporter, exporter=exporter)]
+    if exporter:
+        errors = flush_export(exporter, objects, errors)
+    error = errors[0]
+    if error:
+        raise RuntimeError(f"Failed shard {shard['bucket']}/{shard['key']}: {error}")
+    if "statement" in shard:  # shards queued before the tracker existed have none
+        complete_shard(shard)
+    return {"statusCode": 200, "body": "Processing complete!"}
+
+def flush_export(exporter, objects, errors):
+    # With an export, statements are only deleted once it is uploaded; if it
+    # is not, every statement fails so that it is kept and retried.
+    with stage("export"):
+        exported = exporter.flush()
+    if not exported:
+        print(f"Failed to upload the export of run {exporter.run_id}; keeping the statements for retry")
+        return [error or "Failed to upload the export." for error in errors]
+    return delete_exported(objects, errors)
 
 def lambda_handler(event, context):
+    if "shard" in event:
+        return handle_shard(event["shard"])
     try:
-        ingest_bucket = event['Records'][0]['s3']['bucket']['name']
-        file_key = event['Records'][0]['s3']['object']['key']
-
-
-        local_csv_path = f"/tmp/{file_key.split('/')[-1]}"
-        s3_client.download_file(ingest_bucket, file_key, local_csv_path)
-        dynamo_data = process_csv(local_csv_path)
-
-        new_data = load_new_transactions(local_csv_path)
-
-        for (user_id, year_month), current_transactions in new_data.items():
-            historical_data = query_historical_data(user_id)
-            all_transactions = historical_data + current_transactions
-            home_country = determine_home_country(historical_data)
-            historical_average = calculate_historical_average(historical_data)
-            flagged_transactions = flag_risky_transactions(current_transactions, home_country, historical_average)
-            spending_by_cat = spending_by_category(current_transactions)
-            spending_by_cat_prev = get_previous_month_data(all_transactions, year_month)
-            pie_chart_path = generate_pie_chart(spending_by_cat, spending_by_cat_prev, user_id, year_month)
-            high_value_transaction = identify_high_value_transactions(current_transactions, historical_average)
-            current_year = year_month[:4]
-            recurring_transactions_summary = analyze_recurring_transactions(
-                current_transactions, historical_data, current_year
-            )
-            monthly_spending_trend = calculate_monthly_spending_trend(historical_data, current_transactions)
-            trend_chart_path = generate_bar_line_chart(monthly_spending_trend["MonthlySpending"], user_id, year_month)
-            report = {
-                "UserId": user_id,
-                "YearMonth": year_month,
-                "PieChartPath": pie_chart_path,
-                 "TrendChartPath": trend_chart_path,
-                "FlaggedTransactions": flagged_transactions,
-                "SpendingByCategory": spending_by_cat,
-                "HighValueTransaction": high_value_transaction,
-                "RecurringTransactionsYearToDate": recurring_transactions_summary,
-                "MonthlySpending_Trend": monthly_spending_trend,     
-            }
-            recurring_graph_path = generate_recurring_transactions_graph(report["RecurringTransactionsYearToDate"], user_id, year_month)
-
-            report_file = f"/tmp/user_{user_id}_report_{year_month}.json"
-            with open(report_file, "w") as file:
-                json.dump(report, file, indent=2)
-
-
- 
-            report_s3_key = f"reports/user_{user_id}_report_{year_month}.json"
-            # pie_chart_s3_key = f"reports/user_{user_id}_spending_by_category_{year_month}.png"
-
-            pdf_s3_key = f"reports/user_{user_id}_report_{year_month}.pdf"
-            # trend_chart_s3_key = f"reports/user_{user_id}_spending_trend_{year_month}.png"
-
-            pdf_path = generate_pdf_report(user_id, year_month, pie_chart_path, trend_chart_path, recurring_graph_path, high_value_transaction, flagged_transactions)
-            
-            
-            #upload_to_s3(report_file, "cpsc436c-g9-customer-reports", report_s3_key)
-            # upload_to_s3(pie_chart_path, "cpsc436c-g9-customer-reports", pie_chart_s3_key)
-            upload_to_s3(pdf_path, "cpsc436c-g9-customer-reports", pdf_s3_key)
-            # upload_to_s3(trend_chart_path, "cpsc436c-g9-customer-reports", trend_chart_s3_key)
-       ####### Uplodad to Dynamo  #######
-        for item in dynamo_data:
-            table.put_item(Item=item)
-
-        
-        s3_client.delete_object(Bucket=ingest_bucket, Key=file_key)
-        print(f"Deleted processed file: {file_key} from bucket: {ingest_bucket}")
-        return {"statusCode": 200, "body": "Processing complete!"}
-        
+        objects = list(statement_objects(event))
     except Exception as e:
+        # Not an SQS batch, so there is no item to report; fail the invocation
+        # so that it is retried.
         print(f"Error in lambda_handler: {str(e)}")
-        return {"statusCode": 500, "body": "An error occurred."}
-
+        raise
+
+    exporter = ResultExporter(getattr(context, "aws_request_id", None)) if EXPORT_BUCKET else None
+    pool = render_pool()
+    tracked = set()  # statements that their last shard deletes
+
+    def process(obj):
+        if obj[1] is None:
+            return "Malformed message."
+        with metrics_scope(Bucket=obj[1], Key=obj[2]), stage("statement"):
+            if SHARD_BUCKET and statement_size(obj[1], obj[2]) > SHARD_THRESHOLD_BYTES:
+                dispatcher = make_dispatcher(pool, exporter)
+                if dispatcher.tracked:
+                    tracked.add(obj)  # its shards export their own results
+                    return coordinate_statement(obj[1], obj[2], dispatcher)
+                return coordinate_statement(obj[1], obj[2], dispatcher, delete=not exporter)
+            return process_statement(obj[1], obj[2], pool, delete=not exporter, exporter=exporter)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENT_RECORDS, len(objects)))) as executor:
+        errors = list(executor.map(process, objects))
+    if exporter:
+        errors = flush_export(exporter, [(obj[0], None, None) if obj in tracked else obj for obj in objects], errors)
+
+    # Report failures per SQS message (or per object for direct S3 events) so
+    # that only the failed ones are retried.
+    failed = [identifier for (identifier, _, _), error in zip(objects, errors) if error]
+    batch_item_failures = [{"itemIdentifier": identifier} for identifier in dict.fromkeys(failed)]
+    if not failed:
+        return {"statusCode": 200, "body": "Processing complete!", "batchItemFailures": []}
+    if len(objects) == 1:
+        body = errors[0]
+    else:
+        body = f"Failed to process {len(failed)} of {len(objects)} objects."
+    return {"statusCode": 500, "body": body, "batchItemFailures": batch_item_failures}
@@ -0,0 +1,164 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+import lambda_function as lf
+
+
+def transaction(number, **fields):
+    return {
+        "id": f"t{number}",
+        "date": f"2024-01-{number % 28 + 1:02d}",
+        "vendor": f"Vendor {number % 3}",
+        "category": "Groceries",
+        "amount": Decimal(number).scaleb(-2),
+        "currency": "CAD",
+        "recurring": False,
+        "type": "debit",
+        "location": "CA-BC",
+        "description": "",
+        **fields,
+    }
+
+
+def round_trip(transactions):
+    return lf.decode_transactions(lf.encode_transactions(transactions))
+
+
+def test_pack_column_stores_two_place_decimals_as_cents():
+    column = lf.pack_column([Decimal("1.50"), Decimal("-0.07"), Decimal("12.00")])
+    assert column == {"cents": [150, -7, 1200]}
+    assert [str(value) for value in lf.unpack_column(column)] == ["1.50", "-0.07", "12.00"]
+
+
+@pytest.mark.parametrize("amounts", [
+    ["1.5", "2.25"],
+    ["10", "0.001"],
+    ["1.50", "2"],
+    ["1E+2", "-3.125"],
+])
+def test_decimals_with_other_exponents_round_trip_exactly(amounts):
+    transactions = [transaction(number, amount=Decimal(amount)) for number, amount in enumerate(amounts)]
+    decoded = round_trip(transactions)
+    assert decoded == transactions
+    # Decimal("1.5") == Decimal("1.50"), so compare the digits and exponent too.
+    assert [str(row["amount"]) for row in decoded] == amounts
+
+
+def test_missing_fields_stay_missing():
+    transactions = [transaction(number) for number in range(4)]
+    del transactions[0]["location"], transactions[2]["description"]
+    transactions[2]["note"] = "only here"
+    transactions[3] = {"id": "t3"}
+    decoded = round_trip(transactions)
+    assert decoded == transactions
+    assert [sorted(row) for row in decoded] == [sorted(row) for row in transactions]
+
+
+def test_booleans_keep_their_type_next_to_equal_numbers():
+    flags = [True, 1, Decimal(1), False, 0, True]
+    decoded = round_trip([transaction(number, recurring=flag) for number, flag in enumerate(flags)])
+    assert [(type(row["recurring"]), row["recurring"]) for row in decoded] == [(type(flag), flag) for flag in flags]
+
+
+def test_nested_values_round_trip():
+    transactions = [transaction(number, tags=["a", {"b": Decimal("0.5")}]) for number in range(3)]
+    assert round_trip(transactions) == transactions
+
+
+def test_empty_month_round_trips():
+    assert round_trip([]) == []
+
+
+def test_to_chunk_items_splits_payload_by_chunk_bytes(monkeypatch):
+    monkeypatch.setattr(lf, "COMPACT_CHUNK_BYTES", 64)
+    transactions = [transaction(number) for number in range(40)]
+    payload = lf.encode_transactions(transactions)
+    head, chunks = lf.to_chunk_items("1", "202401", payload, revision=3)
+
+    expected = -(-len(payload) // 64)
+    assert expected > 2
+    assert head["chunks"] == expected
+    assert head["chunk_tag"] == "3."
+    assert head["revision"] == 3
+    assert [item["YearMonth"] for item in chunks] == [f"202401#3.{chunk:03d}" for chunk in range(1, expected)]
+    assert all(len(part) <= 64 for part in [head["payload"]] + [item["payload"] for item in chunks])
+    assert head["payload"] + b"".join(item["payload"] for item in chunks) == payload
+
+    items = [{"UserId": "1", "YearMonth": "202401", **head}] + chunks
+    assert lf.month_transactions(items) == {"202401": transactions}
+
+
+def test_to_chunk_items_without_revision_uses_plain_chunk_keys(monkeypatch):
+    monkeypatch.setattr(lf, "COMPACT_CHUNK_BYTES", 8)
+    head, chunks = lf.to_chunk_items("1", "202401", b"x" * 20)
+    assert "revision" not in head and "chunk_tag" not in head
+    assert [item["YearMonth"] for item in chunks] == ["202401#001", "202401#002"]
+
+
+def test_to_chunk_items_keeps_an_empty_payload_in_the_head():
+    head, chunks = lf.to_chunk_items("1", "202401", b"")
+    assert head["chunks"] == 1 and head["payload"] == b"" and chunks == []
+
+
+def test_missing_chunk_is_an_error(monkeypatch):
+    monkeypatch.setattr(lf, "COMPACT_CHUNK_BYTES", 16)
+    head, chunks = lf.to_chunk_items("1", "202401", lf.encode_transactions([transaction(1)]), revision=1)
+    with pytest.raises(ValueError, match="missing chunk"):
+        lf.month_transactions([{"UserId": "1", "YearMonth": "202401", **head}] + chunks[1:])
+
+
+def write(table, items):
+    for item in items:
+        table[(item["UserId"], item["YearMonth"])] = item
+
+
+def query(table, prefix=""):
+    return [item for key, item in sorted(table.items()) if key[1].startswith(prefix)]
+
+
+def test_month_rewritten_over_leftover_chunks(monkeypatch):
+    monkeypatch.setattr(lf, "COMPACT_CHUNK_BYTES", 32)
+    table = {}
+    larger = [transaction(number) for number in range(30)]
+    smaller = [transaction(number, vendor="Rewritten") for number in range(5)]
+    for revision, transactions in ((1, larger), (2, smaller)):
+        head, chunks = lf.to_chunk_items("1", "202401", lf.encode_transactions(transactions), revision)
+        write(table, chunks + [{"UserId": "1", "YearMonth": "202401", **head}])
+
+    # Revision 1's chunks are still stored next to revision 2's.
+    assert any(key[1].startswith("202401#1.") for key in table)
+    assert lf.month_transactions(query(table)) == {"202401": smaller}
+
+
+def test_rollup_rewritten_over_leftover_chunks(monkeypatch):
+    monkeypatch.setattr(lf, "COMPACT_CHUNK_BYTES", 128)
+    monkeypatch.setattr(lf, "ROLLUP_INLINE_BYTES", 256)
+    table = {}
+    larger = [transaction(number) for number in range(60)]
+    smaller = [transaction(number, vendor="Rewritten") for number in range(20)]
+    write(table, lf.to_rollup_items("1", "202401", larger, revision=1))
+    write(table, lf.to_rollup_items("1", "202401", smaller, revision=2))
+
+    rollups = lf.read_rollups(query(table, lf.ROLLUP_PREFIX))
+    summary, ids, revision, chunk_keys = rollups["202401"]
+    assert revision == 2
+    assert summary == json.loads(json.dumps(lf.summarize_transactions(smaller)))
+    assert ids == lf.pack_transaction_ids(smaller)
+    # Every chunk is listed, so the leftovers of revision 1 can be deleted.
+    stored_chunks = sorted(key[1] for key in table if key[1].count("#") == 2)
+    assert sorted(chunk_keys) == stored_chunks
+    assert any(key.startswith("ROLLUP#202401#1.") for key in chunk_keys)
+
+    index_only = lf.read_rollups(query(table, lf.ROLLUP_PREFIX), summaries=False)
+    assert index_only["202401"][0] is None
+    assert index_only["202401"][1] == ids
+
+
+def test_small_rollup_stays_inline():
+    transactions = [transaction(number) for number in range(3)]
+    (item,) = lf.to_rollup_items("1", "202401", transactions, revision=4)
+    assert item["YearMonth"] == "ROLLUP#202401" and "rollup" in item and "format" not in item
+    summary, ids, revision, chunk_keys = lf.read_rollups([item])["202401"]
+    assert (summary, ids, revision, chunk_keys) == (item["rollup"], lf.pack_transaction_ids(transactions), 4, [])